@@ -10,20 +10,55 @@ average column with the -p or --plot_type argument.  Specifying the
 for all images in the list (if "on").  The save desitation of the plots
 can be specified with the -s or --save_dst argument.  By default, both
 average columns and average row plots will be created, one per image, and
-saved in the current working directory.
+saved in the current working directory.  Long lists can be split across
+several worker processes with the -n or --processes argument, each worker
+taking -c or --chunk_size images at a time.  Giving a --cache_file keeps
+the computed profiles on disk, so that re-plotting the same list does not
+re-read the data.  With -e or --export_file, no plots are made; instead the
+profiles of all images are written to a single .npz file, which can be read
+back with load_profiles.  By default each row or column is averaged with a
+plain mean; -m or --method can instead take the median, or a sigma-clipped
+mean ("clip") that rejects cosmic rays and hot pixels.
 
 The image of interest of the list of images of interest must the the first
 argument for command line execution and must contain the extension and
 indices to plot over.  For example:
 
 python avg_row_col.py abcdefgh_flt.fits[1][100:300,550:650]
+
+The file name, on the command line or in a list, may be a glob pattern such
+as /path/to/*_flt.fits[1][0:2051,0:100], in which case every matching file
+is used.
 '''
 
 import argparse
+import collections
+import glob
+import itertools
+import multiprocessing
 import numpy as np
 import os
 import pyfits
-import matplotlib.pyplot as plt
+import Queue
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# A "frame[ext][y1:y2,x1:x2]" image string.  The frame may be a glob pattern.
+IMAGE_PATTERN = re.compile(r'^\s*([^\[\]]+?)\s*\[\s*(\d+)\s*\]\s*'
+    r'\[\s*(\d+)\s*:\s*(\d+)\s*,\s*(\d+)\s*:\s*(\d+)\s*\]\s*$')
+
+ImageRecord = collections.namedtuple('ImageRecord', 
+    ['frame', 'ext', 'x1', 'x2', 'y1', 'y2'])
+
+# The number of pixels clipped_mean works on at a time, small enough for
+# every pass over them to stay in cache
+CLIP_BLOCK_SIZE = 1 << 18
+
+# -----------------------------------------------------------------------------
 
 class AvgRowCol():
     '''
@@ -32,7 +67,10 @@ class AvgRowCol():
 
     # -------------------------------------------------------------------------
 
-    def __init__(self, images, plot_type, all_switch, save_dst):
+    def __init__(self, images, plot_type, all_switch, save_dst, 
+                 processes=1, chunk_size=100, cache_file=None, 
+                 cache_size=1024, export_file=None, method='mean', 
+                 sigma=3.0, iters=5):
         '''
         Assigns argument variables to class instances.
         '''
@@ -41,6 +79,16 @@ class AvgRowCol():
         self.plot_type = plot_type
         self.all_switch = all_switch
         self.save_dst = save_dst
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.cache_file = cache_file
+        self.cache_size = cache_size
+        self.export_file = export_file
+        self.method = method
+        self.sigma = sigma
+        self.iters = iters
+        self.renderer = None
+        self.cache = None
 
     # -------------------------------------------------------------------------
 
@@ -49,56 +97,70 @@ class AvgRowCol():
         Calculates the average row and column value.
         '''
 
-        self.avg_row_list = [ext_data[x1:x2,y1:y2].mean(axis=1) for ext_data, 
-            x1, x2, y1, y2 in zip(self.ext_data_list, self.x1s, self.x2s, 
-            self.y1s, self.y2s)]
-        self.avg_col_list = [ext_data[x1:x2,y1:y2].mean(axis=0) for ext_data, 
-            x1, x2, y1, y2 in zip(self.ext_data_list, self.x1s, self.x2s, 
-            self.y1s, self.y2s)]
+        self.avg_row_list, self.avg_col_list = calc_profiles(
+            self.section_list, self.method, self.sigma, self.iters)
 
     # -------------------------------------------------------------------------
 
-    def get_image_list(self):
+    def calc_avg_cached(self):
         '''
-        Reads in one image or a list of images and returns a python list of the
-        image(s).  Also ensures each image string contains FITS extension and
-        indices.
+        Fills in the average rows and columns from the profile cache.  Only
+        the images missing from the cache are read and averaged, and their
+        profiles are then added to it.
         '''
 
-        # For single image:
-        if '.fits' in self.images:
-            self.images = [self.images]
+        if self.cache is None:
+            self.cache = ProfileCache(self.cache_file, self.cache_size)
 
-        # For a list of images:
+        if self.method == 'clip':
+            method = 'clip{}x{}'.format(self.sigma, self.iters)
         else:
-            with open(self.images, 'r') as image_file:
-                self.image_list = image_file.readlines()
-            self.image_list = [line.strip() for line in self.image_list]
+            method = self.method
+
+        keys = [ProfileCache.make_key(frame, ext, x1, x2, y1, y2, method) 
+            for frame, ext, x1, x2, y1, y2 in zip(self.frames, self.exts, 
+            self.x1s, self.x2s, self.y1s, self.y2s)]
+        profiles = self.cache.get(keys)
+        missing = [i for i, profile in enumerate(profiles) if profile is None]
 
-        # Ensure images have extension and indices by checking "[" and "]".
-        for image in self.image_list:
-            assert len([i for i in image if i == '[']) == 2, 'Missing or ' + \
-                'Invalid extension or indices.'
-            assert len([i for i in image if i == ']']) == 2, 'Missing or ' + \
-                'Invalid extension or indices.'
+        if missing:
+            self.read_data(missing)
+            self.calc_avg()
+            self.cache.put([keys[i] for i in missing], self.avg_row_list, 
+                           self.avg_col_list)
+            for i, avg_row, avg_col in zip(missing, self.avg_row_list, 
+                                           self.avg_col_list):
+                profiles[i] = (avg_row, avg_col)
+
+        self.avg_row_list = [profile[0] for profile in profiles]
+        self.avg_col_list = [profile[1] for profile in profiles]
 
     # -------------------------------------------------------------------------
 
-    def parse_image_info(self):
+    def close(self):
         '''
-        Determines the extension and indices of the input files.
+        Waits for any queued plots to be written and closes the profile
+        cache.
         '''
 
-        self.frames = [image.split('[')[0] for image in self.image_list]
-        self.exts = [image.split('[')[1][0] for image in self.image_list]
-        y_indices = [image.split('[')[-1].split(',')[0] for image in 
-                     self.image_list]
-        x_indices = [image.split('[')[-1].split(',')[1].strip(']') 
-                     for image in self.image_list]
-        self.x1s = [int(x.split(':')[0]) for x in x_indices]
-        self.x2s = [int(x.split(':')[1]) for x in x_indices]
-        self.y1s = [int(y.split(':')[0]) for y in y_indices]
-        self.y2s = [int(y.split(':')[1]) for y in y_indices]
+        try:
+            if self.renderer is not None:
+                self.renderer.close()
+        finally:
+            if self.cache is not None:
+                self.cache.close()
+                self.cache = None
+
+    # -------------------------------------------------------------------------
+
+    def get_image_list(self):
+        '''
+        Sets image_list to an iterator of ImageRecords for one image or a
+        list of images.  The list file is read one line at a time as the
+        records are consumed.
+        '''
+
+        self.image_list = iter_image_list(self.images)
 
     # -------------------------------------------------------------------------
 
@@ -108,53 +170,162 @@ class AvgRowCol():
         same plot.
         '''
 
-        fig = plt.figure()
-        plt.minorticks_on()
-        plt.grid()
-        plt.xlabel(self.descrip + ' (pixels)', labelpad=10)
-        plt.title('Average of ' + self.anti_descrip + 's')
-        lengths = [len(value) for value in values]
-        plt.xlim([0, max(lengths) - 1])
-        
-        for frame, ext, value in zip(self.frames, self.exts, values):
-            plt.plot(value, markersize=4, markerfacecolor='none', 
-                     label=frame + '[' + ext + ']')
-        plt.legend()
+        labels = ['{}[{}]'.format(frame, ext) for frame, ext in 
+                  zip(self.frames, self.exts)]
         filename = os.path.join(self.save_dst, 
-            'avg_' + self.anti_descrip.lower() + '_ext' + ext + '.png')
-        plt.savefig(filename)
-        print 'Saved figure to ' + filename
+            'avg_' + self.anti_descrip.lower() + '_ext' + str(self.exts[-1]) + 
+            '.png')
+        self.renderer.render_all(values, labels, self.descrip, 
+                                 self.anti_descrip, filename)
+
+    # -------------------------------------------------------------------------
+
+    def plot_data(self):
+        '''
+        Creates the average row and/or column plots requested by plot_type.
+        '''
+
+        if self.renderer is None:
+            self.renderer = ProfileRenderer()
+
+        # Plot the data
+        if self.plot_type == 'row' or self.plot_type == 'both':
+            self.descrip = 'Row'
+            self.anti_descrip = 'Column'
+            if self.all_switch == 'off':
+                self.plot_single_data(self.avg_row_list)
+            elif self.all_switch == 'on':
+                self.plot_all_data(self.avg_row_list)
+        if self.plot_type == 'col' or self.plot_type == 'both':
+            self.descrip = 'Column'
+            self.anti_descrip = 'Row'
+            if self.all_switch == 'off':
+                self.plot_single_data(self.avg_col_list)
+            elif self.all_switch == 'on':
+                self.plot_all_data(self.avg_col_list)
 
     # -------------------------------------------------------------------------
 
     def plot_single_data(self, values):
         '''
-        Creates the average col or row plot for each image.
+        Creates the average col or row plot for each image, named after
+        the file name of the image and saved in save_dst.
         '''
 
         for frame, ext, value in zip(self.frames, self.exts, values):
-            fig = plt.figure()
-            plt.minorticks_on()
-            plt.grid()
-            plt.xlabel(self.descrip + ' (pixels)', labelpad=10)
-            plt.title('Average of ' + self.anti_descrip + 's')
-            plt.xlim([0, len(values[0])])
-            plt.plot(value, 'k', markersize=4, markerfacecolor='none')
-            filename = os.path.join(self.save_dst, frame.split('.')[0] + '_avg_' + \
-                                    self.anti_descrip.lower() + '_ext' + ext + \
+            root = os.path.splitext(os.path.basename(frame))[0]
+            filename = os.path.join(self.save_dst, root + '_avg_' + \
+                                    self.anti_descrip.lower() + '_ext' + str(ext) + \
                                     '.png')
-            plt.savefig(filename)
-            print 'Saved figure to ' + filename
+            self.renderer.render(value, self.descrip, self.anti_descrip, 
+                                 filename)
 
     # -------------------------------------------------------------------------
 
-    def read_data(self):
+    def process_chunk(self, records):
         '''
-        Uses pyfits to read in image data.
+        Reads and averages one chunk of the image list.  Returns the frames,
+        extensions, sections and profiles of the chunk if all_switch is "on"
+        or the profiles are being exported, otherwise plots them and returns
+        None.
         '''
 
-        self.ext_data_list = [pyfits.open(frame)[int(ext)].data for frame, 
-                              ext in zip(self.frames, self.exts)]
+        self.frames, self.exts, self.x1s, self.x2s, self.y1s, self.y2s = \
+            [list(field) for field in zip(*records)]
+        if self.cache_file is not None:
+            self.calc_avg_cached()
+        else:
+            self.read_data()
+            self.calc_avg()
+
+        if self.all_switch == 'on' or self.export_file is not None:
+            sections = zip(self.y1s, self.y2s, self.x1s, self.x2s)
+            return (self.frames, self.exts, sections, self.avg_row_list, 
+                    self.avg_col_list)
+        else:
+            self.plot_data()
+
+    # -------------------------------------------------------------------------
+
+    def read_data(self, indices=None):
+        '''
+        Uses pyfits to read in the requested section of each image, or of
+        only the images at the given indices.
+        '''
+
+        if indices is None:
+            indices = range(len(self.frames))
+
+        self.section_list = read_sections([(self.frames[i], self.exts[i], 
+            self.x1s[i], self.x2s[i], self.y1s[i], self.y2s[i]) for i in 
+            indices])
+
+    # -------------------------------------------------------------------------
+
+    def run_batch(self):
+        '''
+        Splits the image list into chunks of chunk_size images and processes
+        them in list order, one chunk at a time.  If processes is greater
+        than 1 the chunks are handed to a pool of worker processes.  If
+        export_file is given, the profiles are written to it and nothing is
+        plotted.  Otherwise, if all_switch is "on", only the profiles are
+        kept and the combined plot is made at the end.
+        '''
+
+        chunks = iter(lambda: list(itertools.islice(self.image_list, 
+                                                    self.chunk_size)), [])
+
+        frames, exts, avg_rows, avg_cols = [], [], [], []
+
+        writer = None
+        if self.export_file is not None:
+            writer = ProfileWriter(self.export_file)
+
+        pool = None
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+            options = {'plot_type': self.plot_type, 
+                       'all_switch': self.all_switch, 
+                       'save_dst': self.save_dst, 
+                       'cache_file': self.cache_file, 
+                       'cache_size': self.cache_size, 
+                       'export_file': self.export_file, 
+                       'method': self.method, 
+                       'sigma': self.sigma, 
+                       'iters': self.iters}
+            tasks = ((options, chunk) for chunk in chunks)
+            results = pool.imap(_process_chunk, tasks)
+        else:
+            results = itertools.imap(self.process_chunk, chunks)
+
+        try:
+            for result in results:
+                if writer is not None:
+                    writer.add(*result)
+                elif self.all_switch == 'on':
+                    frames.extend(result[0])
+                    exts.extend(result[1])
+                    avg_rows.extend(result[3])
+                    avg_cols.extend(result[4])
+            if pool is not None:
+                pool.close()
+
+            if writer is not None:
+                writer.write()
+            elif self.all_switch == 'on':
+                self.frames, self.exts = frames, exts
+                self.avg_row_list, self.avg_col_list = avg_rows, avg_cols
+                self.plot_data()
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+            if writer is not None:
+                writer.close()
+            self.close()
 
     # -------------------------------------------------------------------------
     # The main controller
@@ -166,31 +337,641 @@ class AvgRowCol():
         '''
 
         self.get_image_list()
-        self.parse_image_info()
-        self.read_data()
-        self.calc_avg()
+        self.run_batch()
 
-        # Set plotting parameters
-        plt.rcParams['legend.fontsize'] = 10
-        plt.rcParams['font.family'] = 'Helvetica'
-        plt.minorticks_on()
+# -----------------------------------------------------------------------------
 
-        # Plot the data
-        if self.plot_type == 'row' or self.plot_type == 'both':
-            self.descrip = 'Row'
-            self.anti_descrip = 'Column'
-            if self.all_switch == 'off':
-                self.plot_single_data(self.avg_row_list)
-            elif self.all_switch == 'on':
-                self.plot_all_data(self.avg_row_list)
-        elif self.plot_type == 'col' or self.plot_type == 'both':
-            self.descrip = 'Column'
-            self.anti_descrip = 'Row'
-            if self.all_switch == 'off':
-                self.plot_single_data(self.avg_col_list)
-            elif self.all_switch == 'on':
-                self.plot_all_data(self.avg_col_list)
+class ProfileCache():
+    '''
+    An on-disk SQLite cache of average row and column profiles.  Entries
+    are keyed on the file path, modification time and size, extension and
+    section, so a changed file is never served stale profiles.  The least
+    recently used entries are evicted once the cache grows past max_size
+    megabytes.
+    '''
+
+    # -------------------------------------------------------------------------
+
+    def __init__(self, cache_file, max_size=1024):
+        '''
+        Opens (and if needed creates) the cache database.
+        '''
+
+        self.max_bytes = int(max_size * 1024 * 1024)
+        self.conn = sqlite3.connect(cache_file, timeout=60)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS profiles ('
+            'key TEXT NOT NULL PRIMARY KEY, dtype TEXT NOT NULL, '
+            'avg_row BLOB NOT NULL, avg_col BLOB NOT NULL, '
+            'nbytes INTEGER NOT NULL, last_used REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS profiles_last_used '
+            'ON profiles (last_used)')
+
+        # Keep a running total of nbytes, so that put only walks the
+        # entries when the cache is over budget.  Recursive triggers make
+        # the rows deleted by INSERT OR REPLACE count as deletes.
+        self.conn.execute('PRAGMA recursive_triggers = ON')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache_size ('
+            'id INTEGER NOT NULL PRIMARY KEY CHECK (id = 0), '
+            'nbytes INTEGER NOT NULL)')
+        self.conn.execute('CREATE TRIGGER IF NOT EXISTS profiles_insert '
+            'AFTER INSERT ON profiles BEGIN UPDATE cache_size '
+            'SET nbytes = nbytes + NEW.nbytes; END')
+        self.conn.execute('CREATE TRIGGER IF NOT EXISTS profiles_delete '
+            'AFTER DELETE ON profiles BEGIN UPDATE cache_size '
+            'SET nbytes = nbytes - OLD.nbytes; END')
+        self.conn.execute('INSERT OR IGNORE INTO cache_size (id, nbytes) '
+            'SELECT 0, coalesce(sum(nbytes), 0) FROM profiles')
+        self.conn.commit()
+
+    # -------------------------------------------------------------------------
+
+    @staticmethod
+    def make_key(frame, ext, x1, x2, y1, y2, method='mean'):
+        '''
+        Returns the cache key of the profiles of a section of a file made
+        with the given method.
+        '''
+
+        stat = os.stat(frame)
+        return '{}|{!r}|{}|{}|{}:{},{}:{}|{}'.format(os.path.abspath(frame), 
+            stat.st_mtime, stat.st_size, ext, y1, y2, x1, x2, method)
+
+    # -------------------------------------------------------------------------
 
+    def close(self):
+        '''
+        Closes the cache database.
+        '''
+
+        self.conn.close()
+
+    # -------------------------------------------------------------------------
+
+    def evict(self):
+        '''
+        Deletes the least recently used entries until the cache is no
+        larger than max_bytes.  The entries are only walked when the
+        running total is over max_bytes.
+        '''
+
+        total = self.get_size()
+        if total <= self.max_bytes:
+            return
+
+        db_cursor = self.conn.execute(
+            'SELECT key, nbytes FROM profiles ORDER BY last_used')
+        stale = []
+        for key, nbytes in db_cursor:
+            if total <= self.max_bytes:
+                break
+            total -= nbytes
+            stale.append((key,))
+        db_cursor.close()
+        self.conn.executemany('DELETE FROM profiles WHERE key = ?', stale)
+
+    # -------------------------------------------------------------------------
+
+    def get(self, keys):
+        '''
+        Returns a list holding an (avg_row, avg_col) tuple for each key, or
+        None where the key is not cached.
+        '''
+
+        found = {}
+        for i in xrange(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            command = 'SELECT key, dtype, avg_row, avg_col FROM profiles ' + \
+                      'WHERE key IN (' + ', '.join('?' * len(batch)) + ')'
+            for key, dtype, avg_row, avg_col in self.conn.execute(command, 
+                                                                  batch):
+                found[key] = (np.frombuffer(avg_row, dtype), 
+                              np.frombuffer(avg_col, dtype))
+
+        now = time.time()
+        self.conn.executemany('UPDATE profiles SET last_used = ? '
+            'WHERE key = ?', [(now, key) for key in found])
+        self.conn.commit()
+
+        return [found.get(key) for key in keys]
+
+    # -------------------------------------------------------------------------
+
+    def get_size(self):
+        '''
+        Returns the total size in bytes of the cached profiles.
+        '''
+
+        return self.conn.execute(
+            'SELECT nbytes FROM cache_size WHERE id = 0').fetchone()[0]
+
+    # -------------------------------------------------------------------------
+
+    def put(self, keys, avg_rows, avg_cols):
+        '''
+        Adds the profiles of the given keys to the cache and evicts old
+        entries if it has grown too large.
+        '''
+
+        now = time.time()
+        rows = []
+        for key, avg_row, avg_col in zip(keys, avg_rows, avg_cols):
+            avg_row = np.ascontiguousarray(avg_row)
+            avg_col = np.ascontiguousarray(avg_col, avg_row.dtype)
+            rows.append((key, avg_row.dtype.str, 
+                         sqlite3.Binary(avg_row.tostring()), 
+                         sqlite3.Binary(avg_col.tostring()), 
+                         avg_row.nbytes + avg_col.nbytes, now))
+
+        self.conn.executemany('INSERT OR REPLACE INTO profiles (key, dtype, '
+            'avg_row, avg_col, nbytes, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+            rows)
+        self.evict()
+        self.conn.commit()
+
+# -----------------------------------------------------------------------------
+
+class ProfileWriter():
+    '''
+    Writes the profiles of all images to a single .npz file, without any
+    plotting.  Profiles are appended to temporary files as they arrive, so
+    they never all sit in memory, and are then packed into flat float32
+    arrays with per-image offsets.  Use load_profiles to read them back.
+    '''
+
+    # -------------------------------------------------------------------------
+
+    def __init__(self, export_file):
+        '''
+        Opens the temporary profile files next to export_file.
+        '''
+
+        self.export_file = export_file
+        self.frames, self.exts, self.sections = [], [], []
+        self.row_lengths, self.col_lengths = [], []
+
+        tmp_dir = os.path.dirname(os.path.abspath(export_file))
+        self.row_file = tempfile.TemporaryFile(dir=tmp_dir)
+        self.col_file = tempfile.TemporaryFile(dir=tmp_dir)
+
+    # -------------------------------------------------------------------------
+
+    def add(self, frames, exts, sections, avg_rows, avg_cols):
+        '''
+        Appends the profiles of one chunk of images.
+        '''
+
+        self.frames.extend(frames)
+        self.exts.extend(exts)
+        self.sections.extend(sections)
+        for avg_row, avg_col in zip(avg_rows, avg_cols):
+            self.row_lengths.append(len(avg_row))
+            self.col_lengths.append(len(avg_col))
+            np.asarray(avg_row, np.float32).tofile(self.row_file)
+            np.asarray(avg_col, np.float32).tofile(self.col_file)
+
+    # -------------------------------------------------------------------------
+
+    def close(self):
+        '''
+        Removes the temporary profile files.
+        '''
+
+        self.row_file.close()
+        self.col_file.close()
+
+    # -------------------------------------------------------------------------
+
+    def read_profiles(self, tmp_file):
+        '''
+        Returns the contents of a temporary profile file as a read-only
+        memory mapped array.
+        '''
+
+        tmp_file.flush()
+        if tmp_file.tell() == 0:
+            return np.zeros(0, np.float32)
+        return np.memmap(tmp_file, np.float32, 'r')
+
+    # -------------------------------------------------------------------------
+
+    def write(self):
+        '''
+        Writes all of the profiles to export_file.
+        '''
+
+        # Through a file object, so that np.savez does not add .npz
+        with open(self.export_file, 'wb') as export_file:
+            np.savez(export_file, 
+                frames=np.array(self.frames, str), 
+                exts=np.array(self.exts, np.int32), 
+                sections=np.array(self.sections, np.int32).reshape(-1, 4), 
+                avg_rows=self.read_profiles(self.row_file), 
+                row_offsets=np.cumsum([0] + self.row_lengths), 
+                avg_cols=self.read_profiles(self.col_file), 
+                col_offsets=np.cumsum([0] + self.col_lengths))
+        print 'Saved profiles to ' + self.export_file
+
+# -----------------------------------------------------------------------------
+
+class ProfileRenderer():
+    '''
+    Renders profile plots with the Agg backend.  Single-image plots reuse
+    one figure, updating the line data in place.  They are queued and
+    drawn and written to PNG by a background thread, so rendering overlaps
+    with reading and averaging the next images.
+    '''
+
+    # -------------------------------------------------------------------------
+
+    def __init__(self, queue_size=10):
+        '''
+        Builds the reusable figure and starts the rendering thread.
+        '''
+
+        import matplotlib
+        matplotlib.rcParams['legend.fontsize'] = 10
+        matplotlib.rcParams['font.family'] = 'Helvetica'
+
+        self.figure, self.axes = self.make_axes()
+        self.line, = self.axes.plot([], [], 'k', markersize=4, 
+                                    markerfacecolor='none')
+
+        self.exc_info = None
+        self.queue = Queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.render_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # -------------------------------------------------------------------------
+
+    def close(self):
+        '''
+        Waits for the queued plots to be written and stops the rendering
+        thread.  Re-raises the first error hit by the thread, if any.
+        '''
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        if self.exc_info is not None:
+            exc_info, self.exc_info = self.exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    # -------------------------------------------------------------------------
+
+    def make_axes(self):
+        '''
+        Returns a new Agg figure and its axes.
+        '''
+
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        axes.minorticks_on()
+        axes.grid()
+
+        return figure, axes
+
+    # -------------------------------------------------------------------------
+
+    def render(self, value, descrip, anti_descrip, filename):
+        '''
+        Queues a single profile plot to be written to filename.
+        '''
+
+        if self.exc_info is not None:
+            self.close()
+        self.queue.put((value, descrip, anti_descrip, filename))
+
+    # -------------------------------------------------------------------------
+
+    def render_all(self, values, labels, descrip, anti_descrip, filename):
+        '''
+        Plots all profiles on one new figure and writes it to filename.
+        '''
+
+        self.queue.join()
+
+        figure, axes = self.make_axes()
+        axes.set_xlabel(descrip + ' (pixels)', labelpad=10)
+        axes.set_title('Average of ' + anti_descrip + 's')
+        axes.set_xlim([0, max(len(value) for value in values) - 1])
+        for value, label in zip(values, labels):
+            axes.plot(value, markersize=4, markerfacecolor='none', 
+                      label=label)
+        axes.legend()
+        figure.savefig(filename)
+        print 'Saved figure to ' + filename
+
+    # -------------------------------------------------------------------------
+
+    def render_loop(self):
+        '''
+        Body of the rendering thread.  Updates the reused figure for each
+        queued plot and saves it, until a None is queued.
+        '''
+
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                if self.exc_info is not None:
+                    continue
+                value, descrip, anti_descrip, filename = item
+                self.axes.set_xlabel(descrip + ' (pixels)', labelpad=10)
+                self.axes.set_title('Average of ' + anti_descrip + 's')
+                self.line.set_data(np.arange(len(value)), value)
+                self.axes.set_xlim([0, len(value)])
+                self.axes.relim()
+                self.axes.autoscale_view(scalex=False)
+                self.figure.savefig(filename)
+                print 'Saved figure to ' + filename
+            except:
+                self.exc_info = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+# -----------------------------------------------------------------------------
+
+def calc_profiles(sections, method='mean', sigma=3.0, iters=5):
+    '''
+    Returns lists of the average row and average column of each section,
+    using the given method (see reduce_profile).  When all sections share
+    a shape they are stacked into one cube and both profiles are reduced
+    across the whole batch at once.  Otherwise each section is reduced on
+    its own.
+    '''
+
+    if len(set(section.shape for section in sections)) == 1:
+        cube = np.array(sections)
+        return (list(reduce_profile(cube, 2, method, sigma, iters)), 
+                list(reduce_profile(cube, 1, method, sigma, iters)))
+
+    avg_rows, avg_cols = [], []
+    for section in sections:
+        avg_rows.append(reduce_profile(section, 1, method, sigma, iters))
+        avg_cols.append(reduce_profile(section, 0, method, sigma, iters))
+
+    return avg_rows, avg_cols
+
+# -----------------------------------------------------------------------------
+
+def clipped_mean(data, axis, sigma=3.0, iters=5):
+    '''
+    Returns the iterative sigma-clipped mean of data along axis.  Each
+    iteration masks the pixels more than sigma standard deviations from
+    the mean of the unmasked pixels along the axis, for at most iters
+    iterations or until no more pixels are masked.  All lines along the
+    axis (and all sections of a stacked cube) are clipped together, a
+    cache-sized block of lines at a time (see _clip_lines).  A line whose
+    remaining pixels would all be masked is left as it is.
+    '''
+
+    data = np.asarray(data)
+    if data.dtype.kind == 'f':
+        dtype = data.dtype
+    else:
+        dtype = np.float64
+
+    # Lines run along the last axis of the view, and blocks are taken
+    # along its first
+    view = np.rollaxis(data, axis, data.ndim)
+    shape = view.shape[:-1]
+    length = view.shape[-1]
+    if view.ndim == 1:
+        return _clip_lines(view.reshape(1, length), dtype, sigma, 
+                           iters)[0].astype(dtype)
+    step = max(CLIP_BLOCK_SIZE // max(view[0].size, 1), 1)
+
+    means = np.empty(shape, dtype)
+    for start in xrange(0, shape[0], step):
+        block = view[start:start + step]
+        means[start:start + step] = _clip_lines(block.reshape(-1, length), 
+            dtype, sigma, iters).reshape(block.shape[:-1])
+
+    return means
+
+# -----------------------------------------------------------------------------
+
+def _clip_lines(lines, dtype, sigma=3.0, iters=5):
+    '''
+    Returns the float64 sigma-clipped mean of each row of the 2-D array
+    lines (see clipped_mean).
+
+    The deviations from the unclipped mean are kept in dtype, with masked
+    pixels set to NaN rather than tracked in a separate mask.  Running
+    sums of the unmasked deviations are kept per line in float64, so each
+    iteration only subtracts the newly masked pixels.  Lines that lost no
+    pixels keep their mean and standard deviation, and so are not tested
+    again.
+    '''
+
+    length = lines.shape[1]
+
+    # Deviations from the mean rounded to dtype
+    origin = lines.mean(1, dtype=np.float64).astype(dtype)
+    dev = np.subtract(lines, origin[:, np.newaxis], dtype=dtype)
+    origin = origin.astype(np.float64)
+    npix = np.empty(len(lines))
+    npix.fill(length)
+    sum1 = dev.sum(1, dtype=np.float64)
+    sum2 = np.einsum('ij,ij->i', dev, dev, dtype=np.float64)
+    active = np.arange(len(lines))
+
+    for i in range(iters):
+        mean = sum1[active] / npix[active]
+        stdev = np.sqrt(np.maximum(sum2[active] / npix[active] - mean ** 2, 
+                                   0))
+        if i == 0:
+            test = dev - mean.astype(dtype)[:, np.newaxis]
+        else:
+            test = dev[active]
+            np.subtract(test, mean.astype(dtype)[:, np.newaxis], out=test)
+        np.abs(test, out=test)
+        with np.errstate(invalid='ignore'):
+            clip = test > (sigma * stdev).astype(dtype)[:, np.newaxis]
+        rows, cols = divmod(np.flatnonzero(clip), length)
+
+        # Never clip the last pixels of a line, so its mean stays defined
+        full = np.bincount(rows, minlength=len(active)) >= npix[active]
+        if full.any():
+            keep = ~full[rows]
+            rows, cols = rows[keep], cols[keep]
+        if len(rows) == 0:
+            break
+
+        rows = active[rows]
+        values = dev[rows, cols].astype(np.float64)
+        dev[rows, cols] = np.nan
+        npix -= np.bincount(rows, minlength=len(lines))
+        sum1 -= np.bincount(rows, values, len(lines))
+        sum2 -= np.bincount(rows, values ** 2, len(lines))
+        active = np.unique(rows)
+
+    return origin + sum1 / npix
+
+# -----------------------------------------------------------------------------
+
+def reduce_profile(data, axis, method='mean', sigma=3.0, iters=5):
+    '''
+    Collapses data along axis with the given method: "mean", "median", or
+    "clip" for an iterative sigma-clipped mean (see clipped_mean).
+    '''
+
+    if method == 'mean':
+        return data.mean(axis=axis)
+    elif method == 'median':
+        return np.median(data, axis=axis)
+    elif method == 'clip':
+        return clipped_mean(data, axis, sigma, iters)
+    else:
+        raise ValueError('Invalid method {}.'.format(method))
+
+# -----------------------------------------------------------------------------
+
+def export_profiles(images, export_file, processes=1, chunk_size=100, 
+                    cache_file=None, cache_size=1024, method='mean', 
+                    sigma=3.0, iters=5):
+    '''
+    Computes the average row and column profiles of one image or a list of
+    images and writes them to export_file without plotting.
+    '''
+
+    avg_row_col = AvgRowCol(images, 'both', 'off', None, processes, 
+                            chunk_size, cache_file, cache_size, export_file, 
+                            method, sigma, iters)
+    avg_row_col.avg_row_col_main()
+
+# -----------------------------------------------------------------------------
+
+def load_profiles(export_file):
+    '''
+    Reads a file written by export_profiles (or the -e option) and returns
+    a dictionary of the frames, extensions, sections (y1, y2, x1, x2) and
+    the avg_row_list and avg_col_list profiles, one entry per image.
+    '''
+
+    with np.load(export_file) as data:
+        if len(data['frames']) == 0:
+            return {'frames': [], 'exts': [], 'sections': [], 
+                    'avg_row_list': [], 'avg_col_list': []}
+        return {'frames': list(data['frames']), 
+                'exts': [int(ext) for ext in data['exts']], 
+                'sections': [tuple(section) for section in data['sections']], 
+                'avg_row_list': np.split(data['avg_rows'], 
+                                         data['row_offsets'][1:-1]), 
+                'avg_col_list': np.split(data['avg_cols'], 
+                                         data['col_offsets'][1:-1])}
+
+# -----------------------------------------------------------------------------
+
+def iter_image_list(images):
+    '''
+    Yields an ImageRecord for one image, or for each image in a text file
+    with one image per line.  The file is read one line at a time.
+    '''
+
+    if IMAGE_PATTERN.match(images):
+        for record in parse_image(images):
+            yield record
+    else:
+        with open(images, 'r') as image_file:
+            for line in image_file:
+                if line.strip():
+                    for record in parse_image(line):
+                        yield record
+
+# -----------------------------------------------------------------------------
+
+def parse_image(image):
+    '''
+    Parses a "frame[ext][y1:y2,x1:x2]" image string and yields an
+    ImageRecord for it, or for each file matching it if the frame is a
+    glob pattern.
+    '''
+
+    match = IMAGE_PATTERN.match(image)
+    assert match is not None, 'Missing or Invalid extension or ' + \
+        'indices: ' + image.strip()
+
+    frame = match.group(1)
+    ext, y1, y2, x1, x2 = [int(group) for group in match.groups()[1:]]
+
+    if glob.has_magic(frame):
+        frames = sorted(glob.glob(frame))
+    else:
+        frames = [frame]
+
+    for frame in frames:
+        yield ImageRecord(frame, ext, x1, x2, y1, y2)
+
+# -----------------------------------------------------------------------------
+
+def _process_chunk(task):
+    '''
+    Worker for AvgRowCol.run_batch.  Runs AvgRowCol.process_chunk over one
+    chunk of the image list and waits for its plots to be written.
+    '''
+
+    options, records = task
+
+    avg_row_col = AvgRowCol(None, **options)
+    try:
+        return avg_row_col.process_chunk(records)
+    finally:
+        avg_row_col.close()
+
+# -----------------------------------------------------------------------------
+
+def read_sections(requests):
+    '''
+    Reads the [x1:x2,y1:y2] section of the given extension for each
+    (frame, ext, x1, x2, y1, y2) request and returns the arrays in request
+    order.  Requests are grouped by frame so that each file is opened once,
+    memory mapped so that only the bytes covering the sections are read
+    (see read_window), and closed before the next file is opened.  Only
+    the headers up to the highest requested extension are parsed.
+    '''
+
+    groups = collections.OrderedDict()
+    for i, request in enumerate(requests):
+        groups.setdefault(request[0], []).append(i)
+
+    sections = [None] * len(requests)
+    for frame, indices in groups.iteritems():
+        with pyfits.open(frame) as hdulist:
+            for i in indices:
+                ext, x1, x2, y1, y2 = requests[i][1:]
+                sections[i] = read_window(hdulist[ext], 
+                                          (slice(x1, x2), slice(y1, y2)))
+
+    return sections
+
+# -----------------------------------------------------------------------------
+
+def read_window(hdu, key):
+    '''
+    Returns a copy of hdu.data[key], in native byte order.  Plain image
+    data are sliced from the memory map pyfits opens them with, so only
+    the pages holding the window are read.  Scaled (BSCALE/BZERO) and
+    compressed data, which .data would read and scale in full, are read
+    through .section instead.
+    '''
+
+    scaled = hdu.header.get('BSCALE', 1) != 1 or \
+        hdu.header.get('BZERO', 0) != 0
+    if (scaled or isinstance(hdu, pyfits.CompImageHDU)) and \
+            hasattr(hdu, 'section'):
+        return hdu.section[key]
+
+    window = hdu.data[key]
+    return np.array(window, window.dtype.newbyteorder('='))
 
 # -----------------------------------------------------------------------------
 # For command line execution
@@ -203,8 +984,8 @@ def parse_args():
 
     # Create help string
     image_help = 'The image(s) (with extension and indices) to be ' + \
-                 'examined.  This could be a single image or a text file' + \
-                 ' containing multiple images.'
+                 'examined.  This could be a single image, a glob ' + \
+                 'pattern, or a text file containing multiple images.'
     plot_type_help = 'The type of plot to be produced. This can be "row"' + \
                      ' for an average row plot, "col" for an average ' + \
                      'column plot, or "both" to produce both types.'
@@ -214,6 +995,25 @@ def parse_args():
     save_dst_help = 'The path to where the plots will be saved.  If no ' + \
                     'value is given, the plots will be displayed on the ' + \
                     'screen.'
+    processes_help = 'The number of worker processes to use.  If greater ' + \
+                     'than 1, the image list is processed in chunks by a ' + \
+                     'pool of workers.'
+    chunk_size_help = 'The number of images handed to a worker process ' + \
+                      'at a time.'
+    cache_file_help = 'Path to a profile cache database.  If given, ' + \
+                      'profiles already in the cache are not re-read, ' + \
+                      'and new profiles are added to it.'
+    export_file_help = 'Path to a .npz file to write the average row and ' + \
+                       'column profiles of all images to.  If given, no ' + \
+                       'plots are made.'
+    method_help = 'How each row or column is collapsed.  This can be ' + \
+                  '"mean", "median", or "clip" for a sigma-clipped mean.'
+    sigma_help = 'The clipping threshold, in standard deviations, for ' + \
+                 'the "clip" method.'
+    iters_help = 'The maximum number of clipping iterations for the ' + \
+                 '"clip" method.'
+    cache_size_help = 'The maximum size of the profile cache in MB.  The ' + \
+                      'least recently used profiles are evicted beyond it.'
 
     # Add time arguments
     parser = argparse.ArgumentParser()
@@ -227,6 +1027,30 @@ def parse_args():
     parser.add_argument('-s', '--save_dst', dest='save_dst', 
                         action='store', type=str, required=False, 
                         default=os.getcwd() + '/', help=save_dst_help)
+    parser.add_argument('-n', '--processes', dest='processes', 
+                        action='store', type=int, required=False, 
+                        default=1, help=processes_help)
+    parser.add_argument('-c', '--chunk_size', dest='chunk_size', 
+                        action='store', type=int, required=False, 
+                        default=100, help=chunk_size_help)
+    parser.add_argument('--cache_file', dest='cache_file', 
+                        action='store', type=str, required=False, 
+                        default=None, help=cache_file_help)
+    parser.add_argument('--cache_size', dest='cache_size', 
+                        action='store', type=float, required=False, 
+                        default=1024, help=cache_size_help)
+    parser.add_argument('-e', '--export_file', dest='export_file', 
+                        action='store', type=str, required=False, 
+                        default=None, help=export_file_help)
+    parser.add_argument('-m', '--method', dest='method', 
+                        action='store', type=str, required=False, 
+                        default='mean', help=method_help)
+    parser.add_argument('--sigma', dest='sigma', 
+                        action='store', type=float, required=False, 
+                        default=3.0, help=sigma_help)
+    parser.add_argument('--iters', dest='iters', 
+                        action='store', type=int, required=False, 
+                        default=5, help=iters_help)
 
     # Parse args
     args = parser.parse_args()
@@ -242,8 +1066,8 @@ def test_args(args):
 
     # Assert image or image list exists.
     images = args.images.split('[')[0]
-    assert os.path.exists(images) == True, 'File ' + images + ' does' + \
-        'not exist.'
+    assert os.path.exists(images) == True or len(glob.glob(images)) > 0, \
+        'File ' + images + ' does not exist.'
 
     # Assert plot_type is "row", "col", or "both".
     valid_plot_types = ['row', 'col', 'both']
@@ -255,6 +1079,18 @@ def test_args(args):
     assert args.all_switch in valid_all_switches, 'Invalid all_switch. ' + \
         'all_switch can be "on" or "off".'
 
+    # Assert processes and chunk_size are positive.
+    assert args.processes > 0, 'processes must be greater than 0.'
+    assert args.chunk_size > 0, 'chunk_size must be greater than 0.'
+    assert args.cache_size > 0, 'cache_size must be greater than 0.'
+
+    # Assert method is "mean", "median", or "clip".
+    valid_methods = ['mean', 'median', 'clip']
+    assert args.method in valid_methods, 'Invalid method. ' + \
+        'method can be "mean", "median", or "clip".'
+    assert args.sigma > 0, 'sigma must be greater than 0.'
+    assert args.iters > 0, 'iters must be greater than 0.'
+
 # -----------------------------------------------------------------------------
 
 if __name__ == '__main__':
@@ -263,5 +1099,8 @@ if __name__ == '__main__':
     test_args(args)
 
     avg_row_col = AvgRowCol(args.images, args.plot_type, args.all_switch,
-                            args.save_dst)
+                            args.save_dst, args.processes, args.chunk_size,
+                            args.cache_file, args.cache_size, 
+                            args.export_file, args.method, args.sigma, 
+                            args.iters)
     avg_row_col.avg_row_col_main()
\ No newline at end of file
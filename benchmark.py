@@ -0,0 +1,503 @@
+#! /usr/bin/env python
+
+'''
+ABOUT:
+This program benchmarks avg_row_col.py and imstat_box.py on synthetic data
+with the geometries of real WFC3 products: a UVIS FLT (two 2051 x 4096
+chips) and an IR IMA (16 reads of 1014 x 1014), each chip or read stored
+as a SCI, ERR and DQ extension triplet.  For each of the entry counts given
+with -s or --sizes (by default 100, 1000, 10000 and 100000) it writes a
+coordinate file with that many regions for imstat_box.py, and a list file
+with that many image sections for avg_row_col.py, and times every stage of
+both pipelines on each geometry.
+
+For example:
+
+python benchmark.py -s 100 1000 -o baseline.json
+
+Each stage is run -r or --repeat times, and the fastest wall time is kept
+along with its CPU time.  The results are written to a JSON file (-o or
+--output, by default benchmark_<date>.json) together with the machine and
+library versions, so that it can serve as a baseline for a later run.
+Given a previous results file with -b or --baseline, every stage that is
+slower than the baseline by more than --threshold (a fraction, by default
+0.2), and by at least 10 ms, is reported as a regression, and the program exits with status 1.
+
+The synthetic data, and the outputs of the tools, are written to a
+temporary directory that is removed afterwards, unless one is given with -w
+or --work_dir.  Histogram plots and average row/column plots are not timed.
+'''
+
+import argparse
+import collections
+from astropy.io import fits as pyfits
+import datetime
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from avg_row_col import calc_profiles
+from avg_row_col import iter_image_list
+from avg_row_col import export_profiles
+from avg_row_col import ProfileWriter
+from avg_row_col import read_sections
+from imstat_box import ImStatBox
+
+# The WFC3 geometries: the shape of one chip or read, and their number.
+GEOMETRIES = {'uvis' : ((2051, 4096), 2), 'ir' : ((1014, 1014), 16)}
+
+# Stages must also be this many seconds slower to count as a regression, so
+# that timer noise in the fastest stages is not reported.
+MIN_SLOWDOWN = 0.01
+
+# -----------------------------------------------------------------------------
+
+class Benchmark():
+    '''
+    Parent class.
+    '''
+
+    # -------------------------------------------------------------------------
+
+    def __init__(self, sizes, output, baseline=None, threshold=0.2, 
+                 repeat=1, work_dir=None, box_size=(5, 30), 
+                 section_size=100, chunk_size=100, processes=1, seed=0):
+        '''
+        Assigns argument variables to class instances.
+        '''
+
+        self.sizes = sizes
+        self.output = output
+        self.baseline = baseline
+        self.threshold = threshold
+        self.repeat = repeat
+        self.work_dir = work_dir
+        self.box_size = box_size
+        self.section_size = section_size
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.seed = seed
+        self.results = []
+
+    # -------------------------------------------------------------------------
+
+    def add_results(self, tool, geometry, size, timer):
+        '''
+        Adds the stage times of one run to the results, keeping the
+        fastest run of each stage.
+        '''
+
+        for stage, (wall, cpu) in timer.times.iteritems():
+            key = (tool, stage, geometry, size)
+            for result in self.results:
+                if (result['tool'], result['stage'], result['geometry'], 
+                    result['entries']) == key:
+                    if wall < result['wall']:
+                        result['wall'], result['cpu'] = wall, cpu
+                    break
+            else:
+                self.results.append({'tool' : tool, 'stage' : stage, 
+                    'geometry' : geometry, 'entries' : size, 'wall' : wall, 
+                    'cpu' : cpu})
+
+    # -------------------------------------------------------------------------
+
+    def bench_avg_row_col(self, geometry, size):
+        '''
+        Times the parse, read, mean, clip and export stages of
+        avg_row_col.py over a list of size sections, a chunk at a time as
+        AvgRowCol.run_batch does, and the whole export pipeline end to end.
+        '''
+
+        list_file = self.make_image_list(geometry, size)
+        export_file = 'profiles.npz'
+
+        for i in range(self.repeat):
+            timer = StageTimer()
+            records = timer.run('parse', list, iter_image_list(list_file))
+            writer = ProfileWriter(export_file)
+            try:
+                for start in range(0, len(records), self.chunk_size):
+                    chunk = records[start:start + self.chunk_size]
+                    sections = timer.run('read', read_sections, chunk)
+                    timer.run('mean', calc_profiles, sections, 'mean')
+                    avg_rows, avg_cols = timer.run('clip', calc_profiles, 
+                                                   sections, 'clip')
+                    frames, exts = [record.frame for record in chunk], \
+                        [record.ext for record in chunk]
+                    sections = [(record.y1, record.y2, record.x1, record.x2) 
+                                for record in chunk]
+                    timer.run('export', writer.add, frames, exts, sections, 
+                              avg_rows, avg_cols)
+                timer.run('export', writer.write)
+            finally:
+                writer.close()
+            timer.run('total', export_profiles, list_file, export_file, 
+                      self.processes, self.chunk_size)
+            self.add_results('avg_row_col', geometry, size, timer)
+
+    # -------------------------------------------------------------------------
+
+    def bench_imstat_box(self, geometry, size):
+        '''
+        Times every stage of imstat_box.py, in both the full and the fast
+        (summed-area table) mode, on the first SCI extension with a
+        coordinate file of size regions.
+        '''
+
+        image = '{}.fits'.format(geometry)
+        coord_list = self.make_coord_list(geometry, size)
+
+        for i in range(self.repeat):
+            timer = StageTimer()
+
+            imstat_box = ImStatBox(image, coord_list, ext=('sci', 1))
+            timer.run('get_coordinates', imstat_box.get_coordinates)
+            timer.run('determine_region', imstat_box.determine_region)
+            timer.run('get_image', imstat_box.get_image)
+            timer.run('build_regions', imstat_box.build_regions)
+            timer.run('sigma_clip', imstat_box.perform_sigma_clip)
+            timer.run('statistics', imstat_box.perform_statistics)
+            timer.run('histograms', imstat_box.calc_histograms)
+            timer.run('write', imstat_box.write_statistics)
+
+            imstat_box = ImStatBox(image, coord_list, 'on', ext=('sci', 1))
+            imstat_box.get_coordinates()
+            imstat_box.determine_region()
+            imstat_box.get_image()
+            timer.run('sat_statistics', imstat_box.perform_sat_statistics)
+
+            imstat_box = ImStatBox(image, coord_list, ext=('sci', 1))
+            timer.run('total', imstat_box.imstat_box_main)
+            self.add_results('imstat_box', geometry, size, timer)
+
+    # -------------------------------------------------------------------------
+
+    def compare_baseline(self):
+        '''
+        Compares the wall times with those of the baseline file and prints
+        the ratios.  Returns the number of stages that regressed.
+        '''
+
+        with open(self.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        times = dict(((result['tool'], result['stage'], result['geometry'], 
+                       result['entries']), result['wall'])
+                     for result in baseline['results'])
+
+        regressions = 0
+        print 'Compared with {} ({})'.format(self.baseline, baseline['date'])
+        print '{:<12} {:<17} {:<5} {:>7} {:>10} {:>10} {:>6}'.format('tool', 
+            'stage', 'geom', 'entries', 'baseline', 'wall', 'ratio')
+        for result in self.results:
+            key = (result['tool'], result['stage'], result['geometry'], 
+                   result['entries'])
+            if key not in times or times[key] <= 0:
+                continue
+            ratio = result['wall'] / times[key]
+            flag = ''
+            if ratio > 1 + self.threshold and \
+                result['wall'] - times[key] > MIN_SLOWDOWN:
+                flag = 'REGRESSION'
+                regressions += 1
+            print '{:<12} {:<17} {:<5} {:>7} {:>10.4f} {:>10.4f} {:>6.2f} {}' \
+                .format(key[0], key[1], key[2], key[3], times[key], 
+                        result['wall'], ratio, flag)
+
+        return regressions
+
+    # -------------------------------------------------------------------------
+
+    def make_coord_list(self, geometry, size):
+        '''
+        Writes a coordinate file of size regions randomly placed on the
+        geometry, half of them boxes and half annuli, and returns its path.
+        '''
+
+        (ny, nx), nchips = GEOMETRIES[geometry]
+        low, high = self.box_size
+
+        height, width = [np.random.randint(low, high + 1, size) for i in
+                         range(2)]
+        box1y1 = np.random.randint(high, ny - 2 * high, size)
+        box1x1 = np.random.randint(high, nx - 2 * high, size)
+        box1y2, box1x2 = box1y1 + height, box1x1 + width
+
+        # Annuli get an outer box up to high pixels wider on each side
+        annulus = np.arange(size) % 2 == 1
+        margin = np.random.randint(1, high + 1, size) * annulus
+        box2y1, box2y2 = box1y1 - margin, box1y2 + margin
+        box2x1, box2x2 = box1x1 - margin, box1x2 + margin
+
+        coord_list = '{}_coords_{}.dat'.format(geometry, size)
+        np.savetxt(coord_list, np.column_stack([box1x1, box1x2, box1y1, 
+            box1y2, box2x1, box2x2, box2y1, box2y2]), fmt='%d')
+
+        return coord_list
+
+    # -------------------------------------------------------------------------
+
+    def make_image(self, geometry):
+        '''
+        Writes a synthetic image of the geometry, with a SCI, ERR and DQ
+        extension per chip or read.
+        '''
+
+        (ny, nx), nchips = GEOMETRIES[geometry]
+
+        hdulist = pyfits.HDUList([pyfits.PrimaryHDU()])
+        for chip in range(1, nchips + 1):
+            sci = np.random.normal(1000.0, 30.0, (ny, nx)).astype(np.float32)
+
+            # Cosmic rays and hot pixels for the clipping to reject
+            hits = np.random.randint(0, ny * nx, ny * nx // 1000)
+            sci.flat[hits] += np.random.exponential(5000.0, hits.size)
+
+            for name, data in (('SCI', sci), 
+                               ('ERR', np.sqrt(np.abs(sci))), 
+                               ('DQ', np.zeros((ny, nx), np.int16))):
+                hdu = pyfits.ImageHDU(data, name=name)
+                hdu.header['EXTVER'] = chip
+                hdulist.append(hdu)
+
+        hdulist.writeto('{}.fits'.format(geometry))
+
+    # -------------------------------------------------------------------------
+
+    def make_image_list(self, geometry, size):
+        '''
+        Writes an avg_row_col.py list file of size section_size square
+        sections of the SCI extensions of the geometry, and returns its
+        path.
+        '''
+
+        (ny, nx), nchips = GEOMETRIES[geometry]
+        image = '{}.fits'.format(geometry)
+
+        exts = 1 + 3 * np.random.randint(0, nchips, size)
+        rows = np.random.randint(0, ny - self.section_size, size)
+        cols = np.random.randint(0, nx - self.section_size, size)
+
+        list_file = '{}_list_{}.txt'.format(geometry, size)
+        with open(list_file, 'w') as image_file:
+            for ext, row, col in zip(exts, rows, cols):
+                image_file.write('{}[{}][{}:{},{}:{}]\n'.format(image, ext, 
+                    col, col + self.section_size, row, 
+                    row + self.section_size))
+
+        return list_file
+
+    # -------------------------------------------------------------------------
+
+    def write_results(self):
+        '''
+        Writes the results and a description of the machine to the output
+        file.
+        '''
+
+        results = {
+            'date' : datetime.datetime.now().isoformat(), 
+            'machine' : platform.node(), 
+            'platform' : platform.platform(), 
+            'processor' : platform.processor(), 
+            'cpu_count' : os.sysconf('SC_NPROCESSORS_ONLN'), 
+            'python' : platform.python_version(), 
+            'numpy' : np.__version__, 
+            'settings' : {'repeat' : self.repeat, 'box_size' : self.box_size, 
+                          'section_size' : self.section_size, 
+                          'chunk_size' : self.chunk_size, 
+                          'processes' : self.processes, 'seed' : self.seed}, 
+            'results' : self.results}
+
+        with open(self.output, 'w') as output_file:
+            json.dump(results, output_file, indent=1, sort_keys=True)
+        print 'Saved results to {}'.format(self.output)
+
+    # -------------------------------------------------------------------------
+    # The main controller
+    # -------------------------------------------------------------------------
+
+    def benchmark_main(self):
+        '''
+        The main controller.  Returns the number of regressions.
+        '''
+
+        np.random.seed(self.seed)
+        remove_work_dir = self.work_dir is None
+        if remove_work_dir:
+            self.work_dir = tempfile.mkdtemp()
+
+        # The tools name their outputs after their inputs, so all of the
+        # synthetic files are made and used in the work directory.
+        cwd = os.getcwd()
+        self.output = os.path.abspath(self.output)
+        if self.baseline is not None:
+            self.baseline = os.path.abspath(self.baseline)
+        os.chdir(self.work_dir)
+
+        try:
+            for geometry in sorted(GEOMETRIES):
+                print 'Writing synthetic {} image'.format(geometry)
+                self.make_image(geometry)
+                for size in self.sizes:
+                    print 'Benchmarking {} with {} entries'.format(geometry, 
+                                                                   size)
+                    self.bench_imstat_box(geometry, size)
+                    self.bench_avg_row_col(geometry, size)
+        finally:
+            os.chdir(cwd)
+            if remove_work_dir:
+                shutil.rmtree(self.work_dir)
+
+        self.write_results()
+
+        if self.baseline is not None:
+            return self.compare_baseline()
+        return 0
+
+# -----------------------------------------------------------------------------
+
+class StageTimer():
+    '''
+    Accumulates the wall and CPU time spent in each stage of a pipeline.
+    '''
+
+    # -------------------------------------------------------------------------
+
+    def __init__(self):
+        '''
+        Starts with no stages.
+        '''
+
+        self.times = collections.OrderedDict()
+
+    # -------------------------------------------------------------------------
+
+    def run(self, stage, function, *args):
+        '''
+        Calls function with args, adds its wall and CPU time (including
+        that of finished child processes) to stage and returns its result.
+        '''
+
+        wall, cpu = time.time(), sum(os.times()[:4])
+        result = function(*args)
+        wall, cpu = time.time() - wall, sum(os.times()[:4]) - cpu
+
+        total_wall, total_cpu = self.times.get(stage, (0.0, 0.0))
+        self.times[stage] = (total_wall + wall, total_cpu + cpu)
+
+        return result
+
+# -----------------------------------------------------------------------------
+# For command line execution
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse command line arguments, returns args object.
+    '''
+
+    # Create help strings
+    sizes_help = 'The numbers of regions and of list entries to ' + \
+                 'benchmark.  Defaults to 100 1000 10000 100000.'
+    output_help = 'Path to the JSON results file.  Defaults to ' + \
+                  'benchmark_<date>.json.'
+    baseline_help = 'Path to a previous results file to compare with.'
+    threshold_help = 'The fraction by which a stage may be slower than ' + \
+                     'the baseline before it is reported as a regression.'
+    repeat_help = 'The number of times to run each stage.  The fastest ' + \
+                  'run is kept.'
+    work_dir_help = 'Directory for the synthetic data, which is then ' + \
+                    'kept.  Defaults to a temporary directory.'
+    box_size_help = 'The smallest and largest side of the imstat_box ' + \
+                    'regions, in pixels.'
+    section_size_help = 'The side of the avg_row_col sections, in pixels.'
+    chunk_size_help = 'The number of avg_row_col sections per chunk.'
+    processes_help = 'The number of worker processes for the end to ' + \
+                     'end avg_row_col run.'
+    seed_help = 'The random seed for the synthetic data.'
+
+    # Add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', 
+        help=sizes_help, action='store', required=False, 
+        default=[100, 1000, 10000, 100000])
+    parser.add_argument('-o', '--output', type=str, help=output_help, 
+        action='store', required=False, default=None)
+    parser.add_argument('-b', '--baseline', type=str, help=baseline_help, 
+        action='store', required=False, default=None)
+    parser.add_argument('--threshold', type=float, help=threshold_help, 
+        action='store', required=False, default=0.2)
+    parser.add_argument('-r', '--repeat', type=int, help=repeat_help, 
+        action='store', required=False, default=1)
+    parser.add_argument('-w', '--work_dir', type=str, help=work_dir_help, 
+        action='store', required=False, default=None)
+    parser.add_argument('--box_size', type=int, nargs=2, 
+        help=box_size_help, action='store', required=False, default=[5, 30])
+    parser.add_argument('--section_size', type=int, 
+        help=section_size_help, action='store', required=False, 
+        default=100)
+    parser.add_argument('-c', '--chunk_size', type=int, 
+        help=chunk_size_help, action='store', required=False, default=100)
+    parser.add_argument('-n', '--processes', type=int, 
+        help=processes_help, action='store', required=False, default=1)
+    parser.add_argument('--seed', type=int, help=seed_help, 
+        action='store', required=False, default=0)
+
+    # Parse args
+    args = parser.parse_args()
+
+    return args
+
+# -----------------------------------------------------------------------------
+
+def test_args(args):
+    '''
+    Ensure valid command line arguments.
+    '''
+
+    # Assert sizes are positive.
+    for size in args.sizes:
+        assert size > 0, 'sizes must be greater than 0.'
+
+    # Assert baseline and work directory exist.
+    if args.baseline is not None:
+        assert os.path.exists(args.baseline) == True, \
+            'File {} does not exist'.format(args.baseline)
+    if args.work_dir is not None:
+        assert os.path.isdir(args.work_dir) == True, \
+            'Directory {} does not exist'.format(args.work_dir)
+
+    # Assert the remaining parameters are valid.
+    assert args.threshold >= 0, 'threshold must not be negative.'
+    assert args.repeat > 0, 'repeat must be greater than 0.'
+    assert 0 < args.box_size[0] <= args.box_size[1] <= 300, \
+        'box_size must be increasing and no larger than 300.'
+    assert 0 < args.section_size < 1014, \
+        'section_size must be between 0 and 1014.'
+    assert args.chunk_size > 0, 'chunk_size must be greater than 0.'
+    assert args.processes > 0, 'processes must be greater than 0.'
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    test_args(args)
+
+    output = args.output
+    if output is None:
+        output = 'benchmark_{}.json'.format(
+            datetime.date.today().strftime('%Y%m%d'))
+
+    benchmark = Benchmark(args.sizes, output, args.baseline, args.threshold, 
+                          args.repeat, args.work_dir, args.box_size, 
+                          args.section_size, args.chunk_size, 
+                          args.processes, args.seed)
+    regressions = benchmark.benchmark_main()
+    sys.exit(1 if regressions else 0)
@@ -1,9 +1,12 @@
 #! /usr/bin/env python
 '''
 ABOUT:
-Checks to see if the last date entry for each table in ql_log.db is today.
+Checks to see if the last date entry for each table in ql_log.db, and for
+each volume in the disk_use table, is today.
 If it is not, updates the table with ID, date, and '-1' values for each
-column for each date between the last date logged and today.
+column for each date between the last date logged and today.  The missing
+rows of each table, and of all volumes, are inserted with a single
+executemany, and all tables are updated in one transaction.
 
 AUTHOR:
 Matthew Bourque
@@ -28,32 +31,45 @@ def check_ql_log():
     '''
 
     database = '/grp/hst/wfc3a/Database/ql_log.db'
-    tables = ['missing', 'wfc3a_disk_use', 'wfc3b_disk_use',
-              'wfc3c_disk_use', 'wfc3d_disk_use', 'wfc3e_disk_use',
-              'wfc3f_disk_use', 'wfc3g_disk_use']
+    tables = ['missing']
 
     # Open database connection
     conn = sqlite3.connect(database)
     conn.text_factory = str
     db_cursor = conn.cursor()
 
-    for table in tables:
-
-        last_date = get_last_date(db_cursor, table)
-        columns, values = get_column_names(db_cursor, table)
-        date_list = dates_to_insert(last_date)
-
-        # Insert "-1" for each date between last_date and today
-        for date in date_list:
-            insert_command = 'INSERT INTO ' + table + '(date, ' + columns + \
-                             ') VALUES ("' + date + '", ' + values + ')'
-            print insert_command
-
-            db_cursor.execute(insert_command)
-            conn.commit()
-
-    # Close database connection
-    conn.close()
+    # Fill the gaps of all tables in a single transaction
+    try:
+        for table in tables:
+
+            last_date = get_last_date(db_cursor, table)
+            columns, values = get_column_names(db_cursor, table)
+            date_list = dates_to_insert(last_date)
+
+            # Insert "-1" for each date between last_date and today
+            insert_command = 'INSERT INTO ' + table + ' (date, ' + columns + \
+                             ') VALUES (?, ' + values + ')'
+            db_cursor.executemany(insert_command, 
+                                  [(date,) for date in date_list])
+            print 'Inserted {} rows into {}'.format(len(date_list), table)
+
+        # Insert "-1"s for each volume and date between the volume's
+        # last_date and today, for all volumes at once
+        rows = [(volume, date) for volume, last_date in 
+                get_last_dates(db_cursor) for date in 
+                dates_to_insert(last_date)]
+        insert_command = 'INSERT INTO disk_use (volume, date, size, ' + \
+                         'used, available) VALUES (?, ?, -1, -1, -1)'
+        db_cursor.executemany(insert_command, rows)
+        print 'Inserted {} rows into disk_use'.format(len(rows))
+
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        # Close database connection
+        conn.close()
 
 # -----------------------------------------------------------------------------
 
@@ -62,13 +78,11 @@ def dates_to_insert(last_date):
     Determines the dates that need to be inserted into ql_log.db.
     '''
 
-    today = datetime.today().strftime('%Y %m %d')
-    next_date = last_date
-    date_list = []
-    while next_date < today:
-        next_date = datetime.strftime(datetime.strptime(next_date, 
-                    '%Y %m %d') + timedelta(1), '%Y %m %d')
-        date_list.append(next_date)
+    # Also accept the 'YYYY MM DD' dates of databases not yet migrated
+    last_date = datetime.strptime(last_date.replace(' ', '-'), '%Y-%m-%d')
+    ndays = (datetime.today() - last_date).days
+    date_list = [(last_date + timedelta(day)).strftime('%Y-%m-%d') 
+                 for day in range(1, ndays + 1)]
 
     return date_list
 
@@ -104,6 +118,20 @@ def get_last_date(db_cursor, table):
 
     return last_date
 
+# -----------------------------------------------------------------------------
+
+def get_last_dates(db_cursor):
+    '''
+    Returns the volume and last date entry of each volume in the disk_use
+    table.
+    '''
+
+    date_query = 'SELECT volume, max(date) FROM disk_use GROUP BY volume'
+    db_cursor.execute(date_query)
+    last_dates = db_cursor.fetchall()
+
+    return last_dates
+
 # -----------------------------------------------------------------------------
 # For command line execution
 # -----------------------------------------------------------------------------
@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+'''
+ABOUT:
+Migrates an existing ql_log.db to the current layout, date encoding and
+indexes, all in one transaction.  Moves the rows of the per-volume
+wfc3*_disk_use tables into the disk_use table, keyed by volume and date,
+and replaces each of those tables with a view of the same name, made as
+in ql_log.py.  Converts every 'YYYY MM DD' date to 'YYYY-MM-DD', which
+sorts the same way and is understood by the SQLite date functions, and adds
+the tables and date indexes of ql_log.sql.  Tables and dates that are already migrated are left
+untouched, so the migration may be run more than once.
+
+For example:
+
+python migrate_ql_log.py ql_log.db
+'''
+
+import argparse
+import os
+import sqlite3
+
+from ql_log import create_volume_views, read_schema
+
+# Converts a 'YYYY MM DD' date to 'YYYY-MM-DD'
+ISO_DATE = "date = replace(date, ' ', '-') WHERE date GLOB " + \
+    "'[0-9][0-9][0-9][0-9] [0-9][0-9] [0-9][0-9]'"
+
+# -----------------------------------------------------------------------------
+
+def consolidate_disk_use(db_cursor):
+    '''
+    Moves the rows of each per-volume <volume>_disk_use table into the
+    disk_use table, and replaces the table with a view.  Views made by an
+    earlier migration get any triggers they are missing.
+    '''
+
+    db_cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' " +
+                      "AND name LIKE '%\\_disk_use' ESCAPE '\\' ORDER BY name")
+    tables = [result[0] for result in db_cursor.fetchall()]
+
+    for table in tables:
+        volume = table[:-len('_disk_use')]
+        db_cursor.execute('INSERT INTO disk_use (volume, date, size, used, ' +
+                          'available) SELECT ?, date, size, used, available ' +
+                          'FROM "' + table + '" ORDER BY date', (volume,))
+        print 'Moved {} rows of {} into disk_use'.format(db_cursor.rowcount,
+                                                         table)
+        db_cursor.execute('DROP TABLE "' + table + '"')
+        create_volume_views(db_cursor, [volume])
+
+    db_cursor.execute("SELECT name FROM sqlite_master WHERE type = 'view' " +
+                      "AND name LIKE '%\\_disk_use' ESCAPE '\\' ORDER BY name")
+    create_volume_views(db_cursor, [result[0][:-len('_disk_use')]
+                                    for result in db_cursor.fetchall()])
+
+# -----------------------------------------------------------------------------
+
+def has_date_index(db_cursor, table):
+    '''
+    Returns True if table has a unique index on date, alone or with other
+    columns.
+    '''
+
+    db_cursor.execute('PRAGMA index_list("' + table + '")')
+    for index in db_cursor.fetchall():
+        name, unique = index[1], index[2]
+        db_cursor.execute('PRAGMA index_info("' + name + '")')
+        columns = [result[2] for result in db_cursor.fetchall()]
+        if unique and 'date' in columns:
+            return True
+
+    return False
+
+# -----------------------------------------------------------------------------
+# The main controller
+# -----------------------------------------------------------------------------
+
+def migrate_ql_log(database):
+    '''
+    The main controller.
+    '''
+
+    conn = sqlite3.connect(database, isolation_level=None)
+    conn.text_factory = str
+    db_cursor = conn.cursor()
+
+    # Explicit transaction, so that the DDL does not commit it part way
+    db_cursor.execute('BEGIN')
+    try:
+        # Any tables and indexes of ql_log.sql the database does not have yet
+        for command in read_schema():
+            db_cursor.execute(command)
+
+        consolidate_disk_use(db_cursor)
+
+        db_cursor.execute('SELECT name FROM sqlite_master WHERE ' +
+                          "type = 'table' ORDER BY name")
+        tables = [result[0] for result in db_cursor.fetchall()]
+
+        for table in tables:
+
+            db_cursor.execute('PRAGMA table_info("' + table + '")')
+            if 'date' not in [result[1] for result in db_cursor.fetchall()]:
+                continue
+
+            # Convert the dates
+            db_cursor.execute('UPDATE ' + table + ' SET ' + ISO_DATE)
+            print 'Converted {} dates in {}'.format(db_cursor.rowcount, table)
+
+            # Index them, unless already indexed by a UNIQUE constraint or
+            # disk_use_volume_date, allowing several runs a day in log_log
+            if has_date_index(db_cursor, table):
+                continue
+            if table == 'log_log':
+                unique = ''
+            else:
+                unique = 'UNIQUE '
+            db_cursor.execute('CREATE ' + unique + 'INDEX IF NOT EXISTS "' +
+                              table + '_date" ON "' + table + '" ("date")')
+
+        db_cursor.execute('COMMIT')
+    except sqlite3.IntegrityError:
+        db_cursor.execute('ROLLBACK')
+        print 'A table has more than one row for a date; nothing was changed'
+        raise
+    except:
+        db_cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+# -----------------------------------------------------------------------------
+# For command line execution
+# -----------------------------------------------------------------------------
+
+def parse_args():
+    '''
+    Parse command line arguments, returns args object.
+    '''
+
+    # Create help strings
+    database_help = 'Path to the database to migrate.'
+
+    # Add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database', type=str, help=database_help)
+
+    # Parse args
+    args = parser.parse_args()
+
+    return args
+
+# -----------------------------------------------------------------------------
+
+def test_args(args):
+    '''
+    Ensure valid command line arguments.
+    '''
+
+    # Assert the database exists.
+    assert os.path.exists(args.database) == True, \
+        'File {} does not exist'.format(args.database)
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    test_args(args)
+
+    migrate_ql_log(args.database)
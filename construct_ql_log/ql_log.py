@@ -1,7 +1,127 @@
+#! /usr/bin/env python
+'''
+ABOUT:
+Builds ql_log.db from scratch.  Creates the tables in ql_log.sql and seeds
+each of them with ID, date (as 'YYYY-MM-DD'), and '-1' values for each
+column for each date from 2011-07-06 to today, and the disk_use table
+likewise for each volume and date.  All of the rows are loaded with
+executemany in a single transaction, with the journal and synchronous
+writes relaxed for the duration of the load.  The former per-volume
+wfc3*_disk_use tables are made as views of disk_use for each volume.
+
+For example:
+
+python ql_log.py ql_log.db
+
+The tables and volumes to seed can be chosen with -t or --tables and -v or
+--volumes.
+'''
+
+import argparse
+import os
 import sqlite3
 import datetime
 from datetime import date, timedelta
 
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'ql_log.sql')
+TABLES = ['missing']
+VOLUMES = ['wfc3a', 'wfc3b', 'wfc3c', 'wfc3d', 'wfc3e', 'wfc3f', 'wfc3g',
+           'wfc3h', 'wfc3i']
+
+# The view of disk_use, and its triggers, that stands in for the former
+# <volume>_disk_use table of one volume.
+VOLUME_VIEW = [
+    '''CREATE VIEW IF NOT EXISTS "{0}_disk_use" AS
+    SELECT "id", "date", "size", "used", "available" FROM "disk_use"
+    WHERE "volume" = '{0}' ''',
+    '''CREATE TRIGGER IF NOT EXISTS "{0}_disk_use_insert"
+INSTEAD OF INSERT ON "{0}_disk_use" BEGIN
+    INSERT INTO "disk_use" ("volume", "date", "size", "used", "available")
+    VALUES ('{0}', NEW."date", NEW."size", NEW."used", NEW."available");
+END''',
+    '''CREATE TRIGGER IF NOT EXISTS "{0}_disk_use_update"
+INSTEAD OF UPDATE ON "{0}_disk_use" BEGIN
+    UPDATE "disk_use" SET "date" = NEW."date", "size" = NEW."size",
+        "used" = NEW."used", "available" = NEW."available"
+    WHERE "id" = OLD."id";
+END''',
+    '''CREATE TRIGGER IF NOT EXISTS "{0}_disk_use_delete"
+INSTEAD OF DELETE ON "{0}_disk_use" BEGIN
+    DELETE FROM "disk_use" WHERE "id" = OLD."id";
+END''']
+
+# -----------------------------------------------------------------------------
+
+def build_ql_log(database, tables=TABLES, volumes=VOLUMES, schema=SCHEMA,
+                 start_date=date(2011, 7, 6), end_date=None):
+    '''
+    Applies the schema to database and seeds each table, and the disk_use
+    table for each volume, with a row of "-1"s for each date from
+    start_date to end_date (by default today).
+    '''
+
+    if end_date is None:
+        end_date = date.today()
+    ndays = (end_date - start_date).days + 1
+    date_list = [(start_date + timedelta(day)).strftime('%Y-%m-%d')
+                 for day in range(ndays)]
+
+    conn = sqlite3.connect(database)
+    db_cursor = conn.cursor()
+
+    with open(schema, 'r') as schema_file:
+        db_cursor.executescript(schema_file.read())
+    create_volume_views(db_cursor, volumes)
+
+    # Relax the journal and syncing for the load
+    journal_mode = db_cursor.execute('PRAGMA journal_mode').fetchone()[0]
+    synchronous = db_cursor.execute('PRAGMA synchronous').fetchone()[0]
+    db_cursor.execute('PRAGMA journal_mode = MEMORY')
+    db_cursor.execute('PRAGMA synchronous = OFF')
+
+    try:
+        for table in tables:
+
+            columns, values = get_column_names(db_cursor, table)
+
+            command = 'INSERT INTO ' + table + ' (id, date, ' + columns + \
+                      ') VALUES (?, ?, ' + values + ')'
+            db_cursor.executemany(command,
+                                  [(i + 1, date_entry) for i, date_entry in
+                                   enumerate(date_list)])
+            print 'Inserted {} rows into {}'.format(len(date_list), table)
+
+        # All volumes at once
+        command = 'INSERT INTO disk_use (volume, date, size, used, ' + \
+                  'available) VALUES (?, ?, -1, -1, -1)'
+        db_cursor.executemany(command,
+                              [(volume, date_entry) for volume in volumes
+                               for date_entry in date_list])
+        print 'Inserted {} rows into disk_use'.format(len(volumes) *
+                                                      len(date_list))
+
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        db_cursor.execute('PRAGMA journal_mode = ' + journal_mode)
+        db_cursor.execute('PRAGMA synchronous = ' + str(synchronous))
+        conn.close()
+
+# -----------------------------------------------------------------------------
+
+def create_volume_views(db_cursor, volumes):
+    '''
+    Creates the <volume>_disk_use view of disk_use, and its triggers, for
+    each volume that does not have them yet.
+    '''
+
+    for volume in volumes:
+        for command in VOLUME_VIEW:
+            db_cursor.execute(command.format(volume))
+
 # -----------------------------------------------------------------------------
 
 def get_column_names(db_cursor, table):
@@ -23,37 +143,76 @@ def get_column_names(db_cursor, table):
 
 # -----------------------------------------------------------------------------
 
-if __name__ == '__main__':
+def read_schema(schema=SCHEMA):
+    '''
+    Returns the statements of the schema file, without its comments and
+    its BEGIN and COMMIT, so that they can be run inside another
+    transaction.
+    '''
 
-    database = '/Users/bourque/wfc3/local_software/construct_ql_log/ql_log.db'
-    tables = ['missing', 'wfc3a_disk_use', 'wfc3b_disk_use',
-              'wfc3c_disk_use', 'wfc3d_disk_use', 'wfc3e_disk_use',
-              'wfc3f_disk_use', 'wfc3g_disk_use', 'wfc3h_disk_use', 
-              'wfc3i_disk_use']
+    statements, statement = [], ''
+    with open(schema, 'r') as schema_file:
+        for line in schema_file:
+            if line.strip().startswith('--'):
+                continue
+            statement += line
+            if sqlite3.complete_statement(statement):
+                statement = statement.strip()
+                if statement.rstrip(';').upper() not in ['BEGIN', 'COMMIT']:
+                    statements.append(statement)
+                statement = ''
 
-    conn = sqlite3.connect(database)
-    db_cursor = conn.cursor()
+    return statements
 
-    for table in tables:
+# -----------------------------------------------------------------------------
+# For command line execution
+# -----------------------------------------------------------------------------
 
-        id = 1
-        date_entry = date(2011, 7, 6)
-        delta = timedelta(days=1)
-        end_date = date.today()
+def parse_args():
+    '''
+    Parse command line arguments, returns args object.
+    '''
 
-        columns, values = get_column_names(db_cursor, table)
+    # Create help strings
+    database_help = 'Path to the database to build.'
+    tables_help = 'The tables to seed, other than disk_use.  Defaults to ' + \
+                  'missing.'
+    volumes_help = 'The volumes to seed in disk_use.  Defaults to wfc3a ' + \
+                   'to wfc3i.'
+    schema_help = 'Path to the schema.  Defaults to the ql_log.sql next ' + \
+                  'to this script.'
 
-        while date_entry <= end_date:
+    # Add arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database', type=str, help=database_help)
+    parser.add_argument('-t', '--tables', type=str, nargs='+',
+        help=tables_help, action='store', required=False, default=TABLES)
+    parser.add_argument('-v', '--volumes', type=str, nargs='*',
+        help=volumes_help, action='store', required=False, default=VOLUMES)
+    parser.add_argument('-s', '--schema', type=str, help=schema_help,
+        action='store', required=False, default=SCHEMA)
 
-            command = 'INSERT INTO ' + table + ' (id, date, ' + columns + \
-                      ') VALUES (' + str(id) + ', "' + \
-                      date_entry.strftime('%Y %m %d') + '", ' + values + ')'
-            
-            date_entry += delta
-            id += 1
-            print command
-
-            db_cursor.execute(command)
-            conn.commit()
-        
-    conn.close()
\ No newline at end of file
+    # Parse args
+    args = parser.parse_args()
+
+    return args
+
+# -----------------------------------------------------------------------------
+
+def test_args(args):
+    '''
+    Ensure valid command line arguments.
+    '''
+
+    # Assert the schema exists.
+    assert os.path.exists(args.schema) == True, \
+        'File {} does not exist'.format(args.schema)
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    test_args(args)
+
+    build_ql_log(args.database, args.tables, args.volumes, args.schema)
@@ -25,77 +25,25 @@ CREATE TABLE IF NOT EXISTS "missing" (
 );
 
 
-CREATE TABLE IF NOT EXISTS "wfc3a_disk_use" (
+-- The disk use of every volume, one row per volume and date.
+CREATE TABLE IF NOT EXISTS "disk_use" (
     "id" INTEGER NOT NULL PRIMARY KEY,
+    "volume" TEXT NOT NULL,
     "date" NOT NULL,
     "size" REAL NOT NULL,
     "used" REAL NOT NULL,
     "available" REAL NOT NULL
 );
 
+-- The former per-volume wfc3*_disk_use tables remain as views of disk_use,
+-- which can also be inserted into, updated and deleted from.  They are made
+-- for each volume from VOLUME_VIEW in ql_log.py.
 
-CREATE TABLE IF NOT EXISTS "wfc3b_disk_use" (
-    "id" INTEGER NOT NULL PRIMARY KEY,
-    "date" NOT NULL,
-    "size" REAL NOT NULL,
-    "used" REAL NOT NULL,
-    "available" REAL NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS "wfc3c_disk_use" (
-    "id" INTEGER NOT NULL PRIMARY KEY,
-    "date" NOT NULL,
-    "size" REAL NOT NULL,
-    "used" REAL NOT NULL,
-    "available" REAL NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS "wfc3d_disk_use" (
-    "id" INTEGER NOT NULL PRIMARY KEY,
-    "date" NOT NULL,
-    "size" REAL NOT NULL,
-    "used" REAL NOT NULL,
-    "available" REAL NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS "wfc3e_disk_use" (
-    "id" INTEGER NOT NULL PRIMARY KEY,
-    "date" NOT NULL,
-    "size" REAL NOT NULL,
-    "used" REAL NOT NULL,
-    "available" REAL NOT NULL
-);
+-- Dates are stored as ISO 'YYYY-MM-DD' strings, which sort and range-query
+-- in date order.  Each table has one row per date (disk_use one per volume
+-- and date, and log_log may have several).
 
-CREATE TABLE IF NOT EXISTS "wfc3f_disk_use" (
-    "id" INTEGER NOT NULL PRIMARY KEY,
-    "date" NOT NULL,
-    "size" REAL NOT NULL,
-    "used" REAL NOT NULL,
-    "available" REAL NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS "wfc3g_disk_use" (
-    "id" INTEGER NOT NULL PRIMARY KEY,
-    "date" NOT NULL,
-    "size" REAL NOT NULL,
-    "used" REAL NOT NULL,
-    "available" REAL NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS "wfc3h_disk_use" (
-    "id" INTEGER NOT NULL PRIMARY KEY,
-    "date" NOT NULL,
-    "size" REAL NOT NULL,
-    "used" REAL NOT NULL,
-    "available" REAL NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS "wfc3i_disk_use" (
-    "id" INTEGER NOT NULL PRIMARY KEY,
-    "date" NOT NULL,
-    "size" REAL NOT NULL,
-    "used" REAL NOT NULL,
-    "available" REAL NOT NULL
-);
+CREATE INDEX IF NOT EXISTS "log_log_date" ON "log_log" ("date");
+CREATE UNIQUE INDEX IF NOT EXISTS "disk_use_volume_date" ON "disk_use" ("volume", "date");
 
 COMMIT;
\ No newline at end of file
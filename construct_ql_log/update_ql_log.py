@@ -1,105 +1,112 @@
 import sqlite3
 
+from migrate_ql_log import ISO_DATE
+
 # -----------------------------------------------------------------------------
 
-def update_disk_stat(orig_database, new_database):
+def update_disk_stat(db_cursor):
     '''
-    Updates the disk stat tables in ql_log.db
+    Updates the disk_use table in ql_log.db, for all volumes at once.
     '''
 
-    tables = ['wfc3a_disk_use', 'wfc3b_disk_use', 'wfc3c_disk_use',
-              'wfc3d_disk_use', 'wfc3e_disk_use', 'wfc3f_disk_use',
-              'wfc3g_disk_use']
-
-    for table in tables:
-    
-        # Get stats from old database
-        conn = sqlite3.connect(orig_database)
-        conn.text_factory = str
-        db_cursor = conn.cursor()
-        command = 'SELECT * FROM ' + table
-        db_cursor.execute(command)
-        results = db_cursor.fetchall()
-        conn.close()
+    # The original database may still have a table per volume
+    db_cursor.execute("SELECT name FROM orig.sqlite_master WHERE " +
+                      "type = 'table' AND name = 'disk_use'")
+    if db_cursor.fetchone() is not None:
+        source = 'SELECT volume, date, size, used, available ' + \
+                 'FROM orig.disk_use'
+    else:
+        db_cursor.execute("SELECT name FROM orig.sqlite_master WHERE " +
+                          "type = 'table' AND name LIKE '%\\_disk_use' " +
+                          "ESCAPE '\\' ORDER BY name")
+        source = ' UNION ALL '.join(["SELECT '" + result[0][:-9] +
+                                     "' AS volume, date, size, used, " +
+                                     "available FROM orig." + result[0]
+                                     for result in db_cursor.fetchall()])
+
+    update_table(db_cursor, 'disk_use', source, ['volume', 'date'])
 
-        # Open connection to new database
-        conn = sqlite3.connect(new_database)
-        db_cursor = conn.cursor()
+# -----------------------------------------------------------------------------
 
-        # Interpret results
-        for i in range(len(results)):
-            date = results[i][1]
-            size = results[i][2]
-            used = results[i][3]
-            available = results[i][4]
+def update_missing(db_cursor):
+    '''
+    Updates the missing table in ql_log.db
+    '''
 
-            # Update the new database
-            command = 'UPDATE ' + table + ' SET size = ' + str(size) + ',' + \
-                       'used = ' + str(used) + ', available = ' + \
-                       str(available) + ' WHERE date = "' + str(date) + '"'
-            print command
+    update_table(db_cursor, 'missing', 'SELECT * FROM orig.missing', ['date'])
 
-            db_cursor.execute(command)
+# -----------------------------------------------------------------------------
 
-        # Commit changes and close connection
-        conn.commit()
-        conn.close()
+def update_table(db_cursor, table, source, keys):
+    '''
+    Sets every column but id and the keys of each row of table to the
+    values of the row with the same keys in the rows selected by source
+    from the original database, attached as "orig", with one UPDATE
+    statement.  Prints the number of rows updated and the number of
+    original rows with no matching keys.
+    '''
 
+    # Get column names from table
+    db_cursor.execute('PRAGMA table_info("' + table + '")')
+    columns = [result[1] for result in db_cursor.fetchall()
+               if result[1] not in ['id'] + keys]
+
+    # Copy the original rows to an indexed temporary table, so that each
+    # row is matched by its keys with an index lookup, converting any
+    # 'YYYY MM DD' dates to 'YYYY-MM-DD'
+    db_cursor.execute('DROP TABLE IF EXISTS temp.orig_rows')
+    db_cursor.execute('CREATE TEMP TABLE orig_rows AS ' + source)
+    db_cursor.execute('UPDATE temp.orig_rows SET ' + ISO_DATE)
+    db_cursor.execute('CREATE INDEX temp.orig_rows_keys ON orig_rows (' +
+                      ', '.join(keys) + ')')
+
+    # Update the new database
+    match = ' AND '.join(['orig_rows.' + key + ' = main.' + table + '.' +
+                          key for key in keys])
+    assignments = ', '.join([column + ' = (SELECT ' + column +
+                             ' FROM orig_rows WHERE ' + match + ')'
+                             for column in columns])
+    db_cursor.execute('UPDATE main.' + table + ' SET ' + assignments +
+                      ' WHERE EXISTS (SELECT 1 FROM orig_rows WHERE ' +
+                      match + ')')
+    matched = db_cursor.rowcount
+
+    db_cursor.execute('SELECT count(*) FROM orig_rows WHERE NOT EXISTS ' +
+                      '(SELECT 1 FROM main.' + table + ' WHERE ' + match +
+                      ')')
+    unmatched = db_cursor.fetchone()[0]
+    db_cursor.execute('DROP TABLE temp.orig_rows')
+
+    print '{}: {} rows updated, {} original rows not matched'.format(table,
+        matched, unmatched)
 
 # -----------------------------------------------------------------------------
+# The main controller
+# -----------------------------------------------------------------------------
 
-def update_missing(orig_database, new_database):
+def update_ql_log(orig_database, new_database):
     '''
-    Updates the missing table in ql_log.db
+    The main controller.  Attaches the original database to the new one
+    and updates the missing and disk stat tables in one transaction.
     '''
 
-    # Get stats from old database
-    conn = sqlite3.connect(orig_database)
+    conn = sqlite3.connect(new_database, isolation_level=None)
     conn.text_factory = str
     db_cursor = conn.cursor()
-    command = 'SELECT * FROM missing'
-    db_cursor.execute(command)
-    results = db_cursor.fetchall()
-    conn.close()
-
-    # Open connection to new database
-    conn = sqlite3.connect(new_database)
-    db_cursor = conn.cursor()
-
-    # Interpret results
-    for i in range(len(results)):
-        date = results[i][1]
-        flt = results[i][2]
-        asn = results[i][3]
-        drz = results[i][4]
-        ima = results[i][5]
-        jif = results[i][6]
-        jit = results[i][7]
-        jpg = results[i][8]
-        raw = results[i][9]
-        spt = results[i][10]
-        trl = results[i][11]
-        crj = results[i][12]
-
-        # Update the new database
-        command = 'UPDATE missing SET flt = ' + str(flt) + ',' + \
-                  'asn = ' + str(asn) + ',' + \
-                  'drz = ' + str(drz) + ',' + \
-                  'ima = ' + str(ima) + ',' + \
-                  'jif = ' + str(jif) + ',' + \
-                  'jit = ' + str(jit) + ',' + \
-                  'jpg = ' + str(jpg) + ',' + \
-                  'raw = ' + str(raw) + ',' + \
-                  'spt = ' + str(spt) + ',' + \
-                  'trl = ' + str(trl) + ',' + \
-                  'crj = ' + str(crj) + ' WHERE date = "' + str(date) + '"'
-        print command
-
-        db_cursor.execute(command)
-
-    # Commit changes and close connection
-    conn.commit()
-    conn.close()
+    db_cursor.execute('ATTACH DATABASE ? AS orig', (orig_database,))
+
+    # Explicit transaction, so that the DDL of the temporary tables does
+    # not commit it part way
+    db_cursor.execute('BEGIN')
+    try:
+        update_missing(db_cursor)
+        update_disk_stat(db_cursor)
+        db_cursor.execute('COMMIT')
+    except:
+        db_cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
 
 # -----------------------------------------------------------------------------
 #   For command line execution
@@ -110,5 +117,4 @@ if __name__ == '__main__':
     orig_database = '/Users/bourque/wfc3/local_software/construct_ql_log/ql_log_orig.db'
     new_database = '/Users/bourque/wfc3/local_software/construct_ql_log/ql_log.db'
 
-    update_missing(orig_database, new_database)
-    update_disk_stat(orig_database, new_database)
\ No newline at end of file
+    update_ql_log(orig_database, new_database)
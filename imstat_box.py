@@ -22,16 +22,43 @@ Note that, if box 2 coordinates are 0 0 0 0, the program will return statistics
 for all pixels within box 1. Also note that, if there are two boxes, box 1 must 
 be the inner box, and box2 must be the outer box.
 
-The program will save the statistics to a file named <image>_<coords>.dat.
+The pixels of each region are sigma clipped about their median before the
+statistics are computed, by default for one iteration at 3 sigma (see the
+--sigma, --iters and --tolerance arguments).  The program will save the
+statistics to a file named <image>_<coords>.dat.  The output also holds a
+histogram of each region, as the counts in --hist_bins bins (columns
+hist_0, hist_1, etc.) shared by all regions and spanning hist_min to
+hist_max, which default to the range of all region pixels.  PNG plots of the
+histograms are only made with -p or --plot_switch "on", optionally for just
+the regions given by --plot_regions, across -n or --processes processes.
+
+With -f or --fast_switch "on", the sigma clipping, median, minimum, maximum
+and histograms are skipped, and only the unclipped npix, mean and stdev of
+each region are computed, in constant time per region, from summed-area
+tables of the image.
+
+Only the window of the image spanned by the regions is read, through a
+memory map.  The image is extension 0 of the file, unless -x or --ext gives
+one or more extension numbers, names or name,version pairs (for example
+-x sci,1 sci,2 for both UVIS chips), each of which is measured in turn and
+saved to <image>_<ext>_<coords>.dat.
+
+If the first argument is a text file listing one image per line instead of
+a FITS image, the same regions are measured on every image, spread across
+-n or --processes worker processes, and the statistics of all images are
+written to a single table (-o or --output, by default <list>_<coords>.dat)
+with one row per image, extension and region, where the image column reads
+<image>[<ext>] for an extension other than 0.  No histogram plots are made
+in this mode.
 '''
 
 import argparse
+import itertools
+import multiprocessing
 from astropy.io import ascii
 from astropy.io import fits as pyfits
-from astropy.stats.funcs import sigma_clip
 import numpy as np
 import os
-import matplotlib.pyplot as plt
 
 # -----------------------------------------------------------------------------
 
@@ -42,104 +69,313 @@ class ImStatBox():
 
     # -------------------------------------------------------------------------
 
-    def __init__(self, image, coord_list):
+    def __init__(self, image, coord_list, fast_switch='off', sigma=3.0, 
+                 iters=1, tolerance=0.0, hist_bins=30, hist_range=None, 
+                 plot_switch='off', plot_regions=None, processes=1, ext=0):
         '''
         Assigns argument variables to class instances.
         '''
 
         self.image = image
         self.coord_list = coord_list
+        self.fast_switch = fast_switch
+        self.sigma = sigma
+        self.iters = iters
+        self.tolerance = tolerance
+        self.hist_bins = hist_bins
+        self.hist_range = hist_range
+        self.plot_switch = plot_switch
+        self.plot_regions = plot_regions
+        self.processes = processes
+        self.ext = ext
+        self.data = None
 
     # -------------------------------------------------------------------------
 
-    def determine_region(self):
+    def build_regions(self):
         '''
-        Determines whether the statistics region is a box or an annlulus based
-        on the coordinates of 'box2'
+        Builds a flat buffer of the pixel values of all regions, where
+        region i is region_buffer[region_offsets[i]:region_offsets[i + 1]].
+        For an annulus, the pixels of the inner box are excluded with a
+        mask, leaving the frame (and any genuine zero-valued pixels)
+        untouched.  Non-finite pixels (NaN or inf, as in drizzled images)
+        are left out of every region, as the fast path's SummedAreaTable
+        leaves them out.
         '''
 
-        # Determine if box2 coordinates are all 0s. If they are, set
-        # region_flag to True
-        self.region_flag_list = []
-        box2_list = [self.box2x1, self.box2x2, self.box2y1, self.box2y2]
-        for box2 in box2_list:
-            if all(element == 0 for element in box2) == True:
-                self.region_flag_list.append(True)
-            else:
-                self.region_flag_list.append(False)
-        
-        # If there are two boxes, stats region is annulus. If there is one
-        # box, stats region is a box.
-        if all(self.region_flag_list) == True:
-            self.region = 'box'
+        floating = self.frame.dtype.kind == 'f'
+        region_list = []
+        for i in range(len(self.data)):
+            if not self.annulus_list[i]:
+                region = self.frame[self.box1y1[i]:self.box1y2[i],
+                                    self.box1x1[i]:self.box1x2[i]]
+                if floating:
+                    region_list.append(region[np.isfinite(region)])
+                else:
+                    region_list.append(region.ravel())
+                continue
+
+            large_box = self.frame[self.box2y1[i]:self.box2y2[i],
+                                   self.box2x1[i]:self.box2x2[i]]
+            mask = np.ones(large_box.shape, bool)
+            y1 = max(self.box1y1[i] - self.box2y1[i], 0)
+            y2 = max(self.box1y2[i] - self.box2y1[i], 0)
+            x1 = max(self.box1x1[i] - self.box2x1[i], 0)
+            x2 = max(self.box1x2[i] - self.box2x1[i], 0)
+            mask[y1:y2,x1:x2] = False
+            if floating:
+                mask &= np.isfinite(large_box)
+            region_list.append(large_box[mask])
+
+        self.region_offsets = np.cumsum([0] + [region.size for region in 
+                                               region_list])
+        if len(region_list) > 0:
+            self.region_buffer = np.concatenate(region_list)
+        else:
+            self.region_buffer = np.zeros(0, self.frame.dtype)
+
+    # -------------------------------------------------------------------------
+
+    def calc_histograms(self):
+        '''
+        Calculates the histogram counts of every region over one set of bin
+        edges shared by all regions.
+        '''
+
+        hist_range = self.get_hist_range()
+        if hist_range is not None:
+            hist_min, hist_max = hist_range
+        else:
+            hist_min, hist_max = 0.0, 1.0
+
+        # As np.histogram does for a single value
+        if hist_min == hist_max:
+            hist_min, hist_max = hist_min - 0.5, hist_max + 0.5
+
+        self.hist_edges = np.linspace(hist_min, hist_max, self.hist_bins + 1)
+        self.hist_counts = region_histograms(self.region_buffer, 
+            self.region_offsets, self.hist_edges)
+
+    # -------------------------------------------------------------------------
+
+    def calc_statistics(self):
+        '''
+        Reads the image and coordinates and calculates the statistics of
+        every region, without writing anything.
+        '''
+
+        self.get_coordinates()
+        self.determine_region()
+        self.get_image()
+
+        if self.fast_switch == 'on':
+            self.perform_sat_statistics()
         else:
-            self.region = 'annulus'
+            self.build_regions()
+            self.perform_sigma_clip()
+            self.perform_statistics()
+            self.calc_histograms()
+
+    # -------------------------------------------------------------------------
+
+    def determine_region(self):
+        '''
+        Determines whether each statistics region is a box or an annulus
+        based on the coordinates of 'box2'.  A region is a box if its box2
+        coordinates are all 0s.
+        '''
+
+        self.annulus_list = (self.box2x1 != 0) | (self.box2x2 != 0) | \
+            (self.box2y1 != 0) | (self.box2y2 != 0)
 
     # -------------------------------------------------------------------------
 
     def get_coordinates(self):
         '''
-        Reads in the data from the coordinates file.
+        Reads in the data from the coordinates file, unless it has already
+        been given as data.
+        '''
+
+        if self.data is None:
+            self.data = ascii.read(self.coord_list, data_start=0, 
+                names=['box1x1', 'box1x2', 'box1y1', 'box1y2', 'box2x1', 
+                'box2x2', 'box2y1', 'box2y2'])
+        self.box1x1 = np.asarray(self.data['box1x1'], int)
+        self.box1x2 = np.asarray(self.data['box1x2'], int)
+        self.box1y1 = np.asarray(self.data['box1y1'], int)
+        self.box1y2 = np.asarray(self.data['box1y2'], int)
+        self.box2x1 = np.asarray(self.data['box2x1'], int)
+        self.box2x2 = np.asarray(self.data['box2x2'], int)
+        self.box2y1 = np.asarray(self.data['box2y1'], int)
+        self.box2y2 = np.asarray(self.data['box2y2'], int)
+
+    # -------------------------------------------------------------------------
+
+    def get_basename(self):
+        '''
+        Returns the root of the output filenames, <image>_<coords>, with
+        the extension inserted for an extension other than 0.
+        '''
+
+        image = self.image.split('.')[0]
+        if self.ext != 0:
+            image = '{}_{}'.format(image, format_ext(self.ext, ''))
+
+        return '{}_{}'.format(image, self.coord_list.split('.')[0])
+
+    # -------------------------------------------------------------------------
+
+    def get_hist_range(self):
+        '''
+        Returns the (min, max) range of the histogram bins: hist_range if
+        given, otherwise the range of the pixels of all regions, or None if
+        there are none.
         '''
 
-        self.data = ascii.read(self.coord_list, data_start=0, names=['box1x1', 
-            'box1x2', 'box1y1', 'box1y2', 'box2x1', 'box2x2', 'box2y1',
-            'box2y2'])
-        self.box1x1 = self.data['box1x1']
-        self.box1x2 = self.data['box1x2']
-        self.box1y1 = self.data['box1y1']
-        self.box1y2 = self.data['box1y2']
-        self.box2x1 = self.data['box2x1']
-        self.box2x2 = self.data['box2x2']
-        self.box2y1 = self.data['box2y1']
-        self.box2y2 = self.data['box2y2']
+        if self.hist_range is not None:
+            return tuple(self.hist_range)
+        if self.region_buffer.size == 0:
+            return None
+
+        return np.nanmin(self.region_buffer), np.nanmax(self.region_buffer)
 
     # -------------------------------------------------------------------------
 
     def get_image(self):
         '''
-        Uses pyfits to read in the zeroth extension image data.
+        Uses pyfits to read in the image data of extension ext, through a
+        memory map and only within the bounding box of all regions (see
+        read_window).  The box coordinates are shifted to the origin of the
+        window read.
+        '''
+
+        # Union of the boxes holding the pixels of each region
+        y1 = np.where(self.annulus_list, self.box2y1, self.box1y1)
+        y2 = np.where(self.annulus_list, self.box2y2, self.box1y2)
+        x1 = np.where(self.annulus_list, self.box2x1, self.box1x1)
+        x2 = np.where(self.annulus_list, self.box2x2, self.box1x2)
+        used = (y2 > y1) & (x2 > x1)
+
+        hdulist = pyfits.open(self.image)
+        try:
+            hdu = hdulist[self.ext]
+            ny, nx = hdu.shape
+            if used.any():
+                wy1 = min(max(y1[used].min(), 0), ny)
+                wy2 = min(max(y2[used].max(), wy1), ny)
+                wx1 = min(max(x1[used].min(), 0), nx)
+                wx2 = min(max(x2[used].max(), wx1), nx)
+            else:
+                wy1 = wy2 = wx1 = wx2 = 0
+            self.frame = read_window(hdu, (slice(wy1, wy2), slice(wx1, wx2)))
+        finally:
+            hdulist.close()
+
+        self.box1y1, self.box1y2, self.box2y1, self.box2y2 = [box - wy1 for 
+            box in (self.box1y1, self.box1y2, self.box2y1, self.box2y2)]
+        self.box1x1, self.box1x2, self.box2x1, self.box2x2 = [box - wx1 for 
+            box in (self.box1x1, self.box1x2, self.box2x1, self.box2x2)]
+
+    # -------------------------------------------------------------------------
+
+    def get_statistics_columns(self):
+        '''
+        Returns the names and values of the statistics columns.
+        '''
+
+        region_list = [i for i in range(len(self.mean_list))]
+        if self.fast_switch == 'on':
+            names = ['region', 'npix', 'mean', 'stdev']
+            columns = [region_list, self.npix_list, self.mean_list, 
+                       self.stdev_list]
+        else:
+            names = ['region', 'npix', 'mean', 'midpt', 'stdev', 'min', 'max']
+            columns = [region_list, self.npix_list, self.mean_list, 
+                       self.midpt_list, self.stdev_list, self.min_list, 
+                       self.max_list]
+
+            # Histogram range and counts
+            names += ['hist_min', 'hist_max']
+            columns += [[self.hist_edges[0]] * len(region_list), 
+                        [self.hist_edges[-1]] * len(region_list)]
+            names += ['hist_{}'.format(i) for i in range(self.hist_bins)]
+            columns += list(self.hist_counts.T)
+
+        return names, columns
+
+    # -------------------------------------------------------------------------
+
+    def perform_sat_statistics(self):
+        '''
+        Calculates the unclipped npix, mean and stdev of every region from
+        summed-area tables of the frame.
         '''
 
-        self.frame = pyfits.open(self.image)[0].data
+        table = SummedAreaTable(self.frame)
+
+        # A box region has no inner box to exclude.
+        inner = [np.where(self.annulus_list, box, 0) for box in 
+                 (self.box1y1, self.box1y2, self.box1x1, self.box1x2)]
+        outer = [np.where(self.annulus_list, box2, box1) for box1, box2 in 
+                 ((self.box1y1, self.box2y1), (self.box1y2, self.box2y2), 
+                  (self.box1x1, self.box2x1), (self.box1x2, self.box2x2))]
+
+        self.npix_list, self.mean_list, self.stdev_list = \
+            table.annulus_statistics(*(outer + inner))
 
     # -------------------------------------------------------------------------
 
     def perform_sigma_clip(self):
         '''
-        Uses astropy.stats.funcs.sigma_clip to perform sigma clipping of data.
+        Sigma clips all regions together with sigma_clip_regions.
         '''
 
-        self.region_list = [sigma_clip(region, sig=3, iters=1)[0] for region 
-                            in self.region_list]
+        self.region_buffer, self.region_offsets = sigma_clip_regions(
+            self.region_buffer, self.region_offsets, self.sigma, self.iters, 
+            self.tolerance)
 
     # -------------------------------------------------------------------------
 
     def perform_statistics(self):
         '''
-        Calculates basic statistics of the region.
+        Calculates basic statistics of all regions at once.
         '''
 
-        self.npix_list = [region.size for region in self.region_list]
-        self.mean_list = [np.mean(region) for region in self.region_list]
-        self.midpt_list = [np.median(region) for region in self.region_list]
-        self.stdev_list = [np.std(region) for region in self.region_list]
-        self.min_list = [np.min(region) for region in self.region_list]
-        self.max_list = [np.max(region) for region in self.region_list]
+        self.npix_list, self.mean_list, self.midpt_list, self.stdev_list, \
+            self.min_list, self.max_list = region_statistics(
+            self.region_buffer, self.region_offsets)
 
     # -------------------------------------------------------------------------
 
     def plot_histograms(self):
         '''
-        Creates a historgram of each region and saves it to a png file.
+        Plots the histogram of each region, or of the regions in
+        plot_regions, from the precomputed counts and saves it to a png
+        file.  The plots are rendered across a pool of processes if
+        processes is greater than 1.
         '''
 
-        for i in range(len(self.region_list)):
-            plt.hist(self.region_list[i], bins=30)
-            filename = '{}_{}_hist_reg_{}.png'.format(self.image.split('.')[0], 
-                self.coord_list.split('.')[0], i)
-            plt.savefig(filename)
-            plt.clf()
+        regions = self.plot_regions
+        if regions is None:
+            regions = range(len(self.hist_counts))
+
+        tasks = [(self.hist_counts[i], self.hist_edges, 
+                  '{}_hist_reg_{}.png'.format(self.get_basename(), i)) 
+                 for i in regions]
+
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                pool.map(_render_histogram, tasks)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for task in tasks:
+                _render_histogram(task)
 
     # -------------------------------------------------------------------------
 
@@ -148,13 +384,9 @@ class ImStatBox():
         Writes statistics to output file.
         '''
 
-        region_list = [i for i in range(len(self.mean_list))]
-        filename = '{}_{}.dat'.format(self.image.split('.')[0], 
-            self.coord_list.split('.')[0])
-        ascii.write([region_list, self.npix_list, self.mean_list, 
-            self.midpt_list, self.stdev_list, self.min_list, self.max_list], 
-            filename, names=['region', 'npix', 'mean', 'midpt', 'stdev', 'min', 
-            'max'])
+        filename = '{}.dat'.format(self.get_basename())
+        names, columns = self.get_statistics_columns()
+        ascii.write(columns, filename, names=names)
 
     # -------------------------------------------------------------------------
     # The main controller
@@ -165,35 +397,455 @@ class ImStatBox():
         The main controller.
         '''
 
-        self.get_image()
-        self.get_coordinates()
-        self.determine_region()
+        self.calc_statistics()
+        self.write_statistics()
 
-        if self.region == 'annulus':
+        if self.fast_switch == 'off' and self.plot_switch == 'on':
+            self.plot_histograms()
 
-            # Set small boxes to all 0s
-            for box1y1, box1y2, box1x1, box1x2 in zip(self.box1y1, self.box1y2,
-                self.box1x1, self.box1x2):
-                    self.frame[box1y1:box1y2,box1x1:box1x2] = 0.0
+# -----------------------------------------------------------------------------
 
-            # Build large box
-            self.large_box_list = [
-                self.frame[b2y1:b2y2,b2x1:b2x2] for b2y1,b2y2,b2x1,b2x2 in 
-                zip(self.box2y1,self.box2y2,self.box2x1,self.box2x2)]
+class SummedAreaTable():
+    '''
+    Summed-area tables (integral images) of the sum, the sum of squares and
+    the number of valid (finite and unmasked) pixels of a frame.  Once
+    built, the npix, mean and stdev of any box, or of any box minus an
+    inner box, cost a handful of lookups regardless of the box size.
+    '''
 
-            # Find indices whose values are not 0.0:
-            self.region_list = [large_box[large_box != 0.0] for large_box in 
-                self.large_box_list]
+    # -------------------------------------------------------------------------
+
+    def __init__(self, frame, mask=None):
+        '''
+        Builds the tables.  Pixels where mask is True are excluded.  The
+        data are offset by their mean first, to keep the sums of squares
+        well conditioned.
+        '''
 
-        elif self.region == 'box':
-            self.region_list = [
-                self.frame[b1y1:b1y2,b1x1:b1x2] for b1y1,b1y2,b1x1,b1x2 in
-                zip(self.box1y1,self.box1y2,self.box1x1,self.box1x2)]
+        valid = np.isfinite(frame)
+        if mask is not None:
+            valid &= ~mask
 
-        self.perform_sigma_clip()
-        self.perform_statistics()
-        self.write_statistics()
-        self.plot_histograms()
+        self.shape = frame.shape
+        self.offset = frame[valid].mean(dtype=np.float64) if valid.any() \
+            else 0.0
+        data = np.where(valid, frame - self.offset, 0.0)
+
+        self.count_table = self.integrate(valid)
+        self.sum_table = self.integrate(data)
+        self.sum2_table = self.integrate(data ** 2)
+
+    # -------------------------------------------------------------------------
+
+    def annulus_statistics(self, y1, y2, x1, x2, iy1, iy2, ix1, ix2):
+        '''
+        Returns arrays of the npix, mean and stdev of each box
+        [y1:y2,x1:x2] minus the part of the inner box [iy1:iy2,ix1:ix2]
+        that falls inside it.  Pass an empty inner box for a plain box.
+        '''
+
+        # Restrict the inner box to the outer box
+        iy1, iy2 = [np.clip(y, y1, np.maximum(y1, y2)) for y in (iy1, iy2)]
+        ix1, ix2 = [np.clip(x, x1, np.maximum(x1, x2)) for x in (ix1, ix2)]
+
+        sums = []
+        for table in (self.count_table, self.sum_table, self.sum2_table):
+            sums.append(self.box_sums(table, y1, y2, x1, x2) - 
+                        self.box_sums(table, iy1, iy2, ix1, ix2))
+        npix, sum1, sum2 = sums
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sum1 / npix
+            stdev = np.sqrt(np.maximum(sum2 / npix - mean ** 2, 0.0))
+
+        return npix.round().astype(int), mean + self.offset, stdev
+
+    # -------------------------------------------------------------------------
+
+    def box_sums(self, table, y1, y2, x1, x2):
+        '''
+        Returns the sums of table over the boxes [y1:y2,x1:x2], with the
+        same clipping to the frame as array slicing.
+        '''
+
+        y1, y2 = [np.clip(y, 0, self.shape[0]) for y in (y1, y2)]
+        x1, x2 = [np.clip(x, 0, self.shape[1]) for x in (x1, x2)]
+        y2, x2 = np.maximum(y2, y1), np.maximum(x2, x1)
+
+        return table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+
+    # -------------------------------------------------------------------------
+
+    def integrate(self, data):
+        '''
+        Returns the zero-padded 2-D cumulative sum of data, such that
+        table[y, x] is the sum of data[:y,:x].
+        '''
+
+        table = np.zeros((data.shape[0] + 1, data.shape[1] + 1))
+        np.cumsum(data, axis=0, out=table[1:,1:])
+        np.cumsum(table[1:,1:], axis=1, out=table[1:,1:])
+
+        return table
+
+# -----------------------------------------------------------------------------
+
+def format_ext(ext, separator=','):
+    '''
+    Returns a FITS extension (see parse_ext) as a string, joining the name
+    and version of a (name, version) pair with separator.
+    '''
+
+    if isinstance(ext, tuple):
+        return '{}{}{}'.format(ext[0], separator, ext[1])
+
+    return str(ext)
+
+# -----------------------------------------------------------------------------
+
+def imstat_box_batch(image_list, coord_list, output, processes=1, exts=(0,), 
+                     **options):
+    '''
+    Measures the regions in coord_list on every image listed (one per line)
+    in image_list, spread across a pool of worker processes, and writes the
+    statistics of all images to a single table in output, with one row
+    per image, extension and region.  Results are written in list order
+    as they arrive.  Any other options are passed on to ImStatBox.
+
+    All rows share one set of histogram bin edges.  Unless hist_range is
+    given, a first pass over every image finds the range of the clipped
+    pixels of all regions of all images.
+    '''
+
+    with open(image_list, 'r') as image_file:
+        images = [line.strip() for line in image_file if line.strip()]
+
+    # Read the coordinates once and hand them to every worker
+    coords = ImStatBox(None, coord_list)
+    coords.get_coordinates()
+    options['coord_list'] = coord_list
+
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (coords.data,))
+        imap = pool.imap
+    else:
+        _init_worker(coords.data)
+        imap = itertools.imap
+
+    try:
+        # Fix the histogram bins of every image to the range of all images
+        if options.get('fast_switch', 'off') == 'off' and \
+                options.get('hist_range') is None:
+            tasks = ((image, dict(options, ext=ext)) for image in images 
+                     for ext in exts)
+            ranges = [hist_range for hist_range in imap(_process_range, tasks) 
+                      if hist_range is not None]
+            if ranges:
+                options['hist_range'] = (min(low for low, high in ranges), 
+                                         max(high for low, high in ranges))
+
+        tasks = ((image, dict(options, ext=ext)) for image in images 
+                 for ext in exts)
+        results = imap(_process_image, tasks)
+        with open(output, 'w') as output_file:
+            for i, (image, names, columns) in enumerate(results):
+                if i == 0:
+                    output_file.write(' '.join(['image'] + names) + '\n')
+                columns = [np.asarray(column).tolist() for column in columns]
+                for row in zip(*columns):
+                    output_file.write(' '.join([image] + 
+                        [repr(value) for value in row]) + '\n')
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+
+    print 'Saved statistics to {}'.format(output)
+
+# -----------------------------------------------------------------------------
+
+def is_fits(filename):
+    '''
+    Returns True if filename can be opened as a FITS file (compressed or
+    not, whatever its suffix), and False otherwise, e.g. for a text list
+    of images.
+    '''
+
+    try:
+        hdulist = pyfits.open(filename)
+    except (IOError, OSError):
+        return False
+    hdulist.close()
+
+    return True
+
+# -----------------------------------------------------------------------------
+
+def parse_ext(ext):
+    '''
+    Parses a FITS extension given as a number ('1'), a name ('sci') or a
+    name and version ('sci,1') into the form pyfits indexes by.
+    '''
+
+    if ',' in ext:
+        name, version = ext.split(',')
+        return name, int(version)
+    if ext.isdigit():
+        return int(ext)
+
+    return ext
+
+# -----------------------------------------------------------------------------
+
+def read_window(hdu, key):
+    '''
+    Returns a copy of hdu.data[key], in native byte order.  Plain image
+    data are sliced from the memory map pyfits opens them with, so only
+    the pages holding the window are read.  Scaled (BSCALE/BZERO) and
+    compressed data, which .data would read and scale in full, are read
+    through .section instead, where pyfits offers it.
+    '''
+
+    scaled = hdu.header.get('BSCALE', 1) != 1 or \
+        hdu.header.get('BZERO', 0) != 0
+    if (scaled or isinstance(hdu, pyfits.CompImageHDU)) and \
+            hasattr(hdu, 'section'):
+        return hdu.section[key]
+
+    window = hdu.data[key]
+    return np.array(window, window.dtype.newbyteorder('='))
+
+# -----------------------------------------------------------------------------
+
+def region_medians(buffer, offsets):
+    '''
+    Returns the median of each region of a flat buffer (see
+    region_statistics), or NaN for empty regions.  Medians are found by
+    partitioning rather than sorting, with regions of the same size
+    partitioned together.
+    '''
+
+    offsets = np.asarray(offsets)
+    npix = np.diff(offsets)
+    midpt = np.empty(len(npix))
+    midpt.fill(np.nan)
+
+    for length in np.unique(npix[npix > 0]):
+        group = np.flatnonzero(npix == length)
+        values = buffer[offsets[group][:, np.newaxis] + np.arange(length)]
+        lower, upper = (length - 1) // 2, length // 2
+        values = np.partition(values, [lower, upper], axis=1)
+        midpt[group] = (values[:, lower].astype(np.float64) + 
+                        values[:, upper]) / 2.0
+
+    return midpt
+
+# -----------------------------------------------------------------------------
+
+def region_moments(buffer, offsets):
+    '''
+    Returns the mean and (population) stdev of each region of a flat
+    buffer (see region_statistics), or NaN for empty regions.  Both come
+    from one reduction each of the sums and sums of squares over the whole
+    buffer, offset by the mean of its finite pixels for conditioning, so
+    that a NaN or infinite pixel only spoils its own region.
+    '''
+
+    npix = np.diff(offsets)
+    mean, stdev = np.empty(len(npix)), np.empty(len(npix))
+    mean.fill(np.nan)
+    stdev.fill(np.nan)
+
+    # Regions are contiguous, so reducing at the start of each non-empty
+    # region covers exactly its pixels.
+    nonempty = np.flatnonzero(npix > 0)
+    if len(nonempty) == 0:
+        return mean, stdev
+    starts = offsets[nonempty]
+    count = npix[nonempty]
+
+    offset = buffer.mean(dtype=np.float64)
+    if not np.isfinite(offset):
+        finite = np.isfinite(buffer)
+        offset = buffer[finite].mean(dtype=np.float64) if finite.any() \
+            else 0.0
+    data = buffer - offset
+    mean[nonempty] = np.add.reduceat(data, starts) / count
+    stdev[nonempty] = np.sqrt(np.maximum(
+        np.add.reduceat(data * data, starts) / count - mean[nonempty] ** 2, 
+        0.0))
+    mean[nonempty] += offset
+
+    return mean, stdev
+
+# -----------------------------------------------------------------------------
+
+def region_statistics(buffer, offsets):
+    '''
+    Returns arrays of the npix, mean, median, stdev, min and max of each
+    region of a flat buffer of concatenated region pixels, where region i
+    is buffer[offsets[i]:offsets[i + 1]].  Empty regions get NaNs.
+
+    Each statistic is computed for all regions at once (see region_moments
+    and region_medians), rather than with one pass per region.
+    '''
+
+    offsets = np.asarray(offsets)
+    npix = np.diff(offsets)
+    mean, stdev = region_moments(buffer, offsets)
+    midpt = region_medians(buffer, offsets)
+
+    minimum, maximum = np.empty(len(npix)), np.empty(len(npix))
+    minimum.fill(np.nan)
+    maximum.fill(np.nan)
+    nonempty = np.flatnonzero(npix > 0)
+    if len(nonempty) > 0:
+        minimum[nonempty] = np.minimum.reduceat(buffer, offsets[nonempty])
+        maximum[nonempty] = np.maximum.reduceat(buffer, offsets[nonempty])
+
+    return npix, mean, midpt, stdev, minimum, maximum
+
+# -----------------------------------------------------------------------------
+
+def region_histograms(buffer, offsets, edges):
+    '''
+    Returns an array of shape (number of regions, number of bins) holding
+    the histogram counts of each region of a flat buffer (see
+    region_statistics) over the shared bin edges.  Counts match
+    np.histogram: the last bin includes its right edge, and values outside
+    the edges are ignored.  All regions are binned in one pass.
+    '''
+
+    nregions, nbins = len(offsets) - 1, len(edges) - 1
+    region = np.repeat(np.arange(nregions), np.diff(offsets))
+    bins = np.searchsorted(edges, buffer, 'right') - 1
+    bins[buffer == edges[-1]] = nbins - 1
+    inside = (bins >= 0) & (bins < nbins)
+
+    counts = np.bincount(region[inside] * nbins + bins[inside], 
+                         minlength=nregions * nbins)
+
+    return counts.reshape(nregions, nbins)
+
+# -----------------------------------------------------------------------------
+
+def _render_histogram(task):
+    '''
+    Plots one precomputed histogram and saves it to a png file.
+    '''
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    counts, edges, filename = task
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.hist(edges[:-1], edges, weights=counts)
+    figure.savefig(filename)
+
+# -----------------------------------------------------------------------------
+
+def sigma_clip_regions(buffer, offsets, sigma=3.0, iters=1, tolerance=0.0):
+    '''
+    Sigma clips every region of a flat buffer (see region_statistics) and
+    returns the clipped buffer and its offsets.  Each iteration removes the
+    pixels further than sigma times the stdev from the median of their
+    region, as astropy's sigma_clip does by default.  A region stops being
+    clipped once an iteration removes none of its pixels, or changes its
+    stdev by no more than the fraction tolerance.  All regions are clipped
+    together, for at most iters iterations.
+    '''
+
+    offsets = np.asarray(offsets)
+    nregions = len(offsets) - 1
+    active = np.ones(nregions, bool)
+    last_stdev = None
+
+    for i in range(iters):
+        npix = np.diff(offsets)
+        mean, stdev = region_moments(buffer, offsets)
+        if last_stdev is not None and tolerance > 0:
+            with np.errstate(invalid='ignore'):
+                active &= ~(np.abs(stdev - last_stdev) <= 
+                            tolerance * last_stdev)
+        if not active.any():
+            break
+        last_stdev = stdev
+
+        region = np.repeat(np.arange(nregions), npix)
+        center = region_medians(buffer, offsets)
+        keep = np.abs(buffer - center[region]) <= sigma * stdev[region]
+        keep |= ~active[region]
+        if keep.all():
+            break
+
+        count = np.bincount(region, keep, nregions).astype(int)
+        active &= count < npix
+        buffer = buffer[keep]
+        offsets = np.concatenate([[0], np.cumsum(count)])
+
+    return buffer, offsets
+
+# -----------------------------------------------------------------------------
+
+def _init_worker(data):
+    '''
+    Initializer for the imstat_box_batch workers.  Stores the coordinates
+    shared by every image.
+    '''
+
+    global _coord_data
+    _coord_data = data
+
+# -----------------------------------------------------------------------------
+
+def _process_image(task):
+    '''
+    Worker for imstat_box_batch.  Calculates the statistics of one image and
+    returns the image name with the names and values of the statistics
+    columns.
+    '''
+
+    image, options = task
+
+    imstat_box = ImStatBox(image, **options)
+    imstat_box.data = _coord_data
+    imstat_box.calc_statistics()
+    names, columns = imstat_box.get_statistics_columns()
+
+    if imstat_box.ext != 0:
+        image = '{}[{}]'.format(image, format_ext(imstat_box.ext))
+
+    return image, names, columns
+
+# -----------------------------------------------------------------------------
+
+def _process_range(task):
+    '''
+    Worker for the first pass of imstat_box_batch.  Reads and clips the
+    regions of one image and returns the range of their pixels, or None if
+    they are empty.
+    '''
+
+    image, options = task
+
+    imstat_box = ImStatBox(image, **options)
+    imstat_box.data = _coord_data
+    imstat_box.get_coordinates()
+    imstat_box.determine_region()
+    imstat_box.get_image()
+    imstat_box.build_regions()
+    imstat_box.perform_sigma_clip()
+
+    return imstat_box.get_hist_range()
 
 # -----------------------------------------------------------------------------
 # For command line execution
@@ -205,13 +857,60 @@ def parse_args():
     '''
 
     # Create help strings
-    image_help = 'Path to image to be analyzed.'
+    image_help = 'Path to image to be analyzed, or to a text file ' + \
+                 'listing one image per line.'
     coord_list_help = 'Path to file containing rectangle coordinates.'
+    fast_switch_help = 'If "on", only the unclipped npix, mean and stdev ' + \
+                       'of each region are computed, from summed-area ' + \
+                       'tables.  If "off", the regions are sigma clipped ' + \
+                       'and all statistics and histograms are produced.'
+    sigma_help = 'The clipping threshold, in standard deviations.'
+    iters_help = 'The maximum number of clipping iterations.'
+    tolerance_help = 'Stop clipping a region once an iteration changes ' + \
+                     'its stdev by no more than this fraction.'
+    hist_bins_help = 'The number of histogram bins.'
+    hist_range_help = 'The lower and upper edges of the histogram bins.  ' + \
+                      'Defaults to the range of all region pixels (of ' + \
+                      'all images, found with an extra pass, for a list).'
+    plot_switch_help = 'If "on", a png plot of the histogram of each ' + \
+                       'region is saved.'
+    plot_regions_help = 'Comma-separated list of the regions to plot ' + \
+                        'histograms of.  Defaults to all regions.'
+    processes_help = 'The number of worker processes to use for a list ' + \
+                     'of images, or for plotting histograms.'
+    ext_help = 'The extensions to measure, each a number, a name or a ' + \
+               'name,version pair.  Defaults to 0.'
+    output_help = 'Path to the combined statistics table for a list of ' + \
+                  'images.  Defaults to <list>_<coords>.dat.'
 
     # Add arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('image', type=str, help=image_help)
     parser.add_argument('coord_list', type=str, help=coord_list_help)
+    parser.add_argument('-f', '--fast_switch', type=str, 
+        help=fast_switch_help, action='store', required=False, 
+        default='off')
+    parser.add_argument('--sigma', type=float, help=sigma_help, 
+        action='store', required=False, default=3.0)
+    parser.add_argument('--iters', type=int, help=iters_help, 
+        action='store', required=False, default=1)
+    parser.add_argument('--tolerance', type=float, help=tolerance_help, 
+        action='store', required=False, default=0.0)
+    parser.add_argument('--hist_bins', type=int, help=hist_bins_help, 
+        action='store', required=False, default=30)
+    parser.add_argument('--hist_range', type=float, nargs=2, 
+        help=hist_range_help, action='store', required=False, default=None)
+    parser.add_argument('-p', '--plot_switch', type=str, 
+        help=plot_switch_help, action='store', required=False, 
+        default='off')
+    parser.add_argument('--plot_regions', type=str, help=plot_regions_help, 
+        action='store', required=False, default=None)
+    parser.add_argument('-n', '--processes', type=int, 
+        help=processes_help, action='store', required=False, default=1)
+    parser.add_argument('-x', '--ext', type=str, nargs='+', help=ext_help, 
+        action='store', required=False, default=['0'])
+    parser.add_argument('-o', '--output', type=str, help=output_help, 
+        action='store', required=False, default=None)
 
     # Parse args
     args = parser.parse_args()
@@ -231,6 +930,26 @@ def test_args(args):
     assert os.path.exists(args.coord_list) == True, \
         'File {} does not exist'.format(args.coord_list)
 
+    # Assert fast_switch is "on" or "off".
+    assert args.fast_switch in ['on', 'off'], \
+        'fast_switch can be "on" or "off".'
+
+    # Assert clipping parameters are valid.
+    assert args.sigma > 0, 'sigma must be greater than 0.'
+    assert args.iters > 0, 'iters must be greater than 0.'
+    assert args.tolerance >= 0, 'tolerance must not be negative.'
+
+    # Assert histogram parameters are valid.
+    assert args.hist_bins > 0, 'hist_bins must be greater than 0.'
+    if args.hist_range is not None:
+        assert args.hist_range[0] < args.hist_range[1], \
+            'hist_range must be increasing.'
+    assert args.plot_switch in ['on', 'off'], \
+        'plot_switch can be "on" or "off".'
+
+    # Assert processes is positive.
+    assert args.processes > 0, 'processes must be greater than 0.'
+
 # -----------------------------------------------------------------------------
 
 if __name__ == '__main__':
@@ -238,5 +957,28 @@ if __name__ == '__main__':
     args = parse_args()
     test_args(args)
 
-    imstat_box = ImStatBox(args.image, args.coord_list)
-    imstat_box.imstat_box_main()
\ No newline at end of file
+    plot_regions = None
+    if args.plot_regions is not None:
+        plot_regions = [int(region) for region in 
+                        args.plot_regions.split(',')]
+
+    exts = [parse_ext(ext) for ext in args.ext]
+
+    if is_fits(args.image):
+        for ext in exts:
+            imstat_box = ImStatBox(args.image, args.coord_list, 
+                                   args.fast_switch, args.sigma, args.iters, 
+                                   args.tolerance, args.hist_bins, 
+                                   args.hist_range, args.plot_switch, 
+                                   plot_regions, args.processes, ext)
+            imstat_box.imstat_box_main()
+    else:
+        output = args.output
+        if output is None:
+            output = '{}_{}.dat'.format(args.image.split('.')[0], 
+                args.coord_list.split('.')[0])
+        imstat_box_batch(args.image, args.coord_list, output, args.processes, 
+                         exts, fast_switch=args.fast_switch, sigma=args.sigma, 
+                         iters=args.iters, tolerance=args.tolerance, 
+                         hist_bins=args.hist_bins, 
+                         hist_range=args.hist_range)
\ No newline at end of file
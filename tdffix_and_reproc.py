@@ -1,45 +1,433 @@
-import sys
-import pyfits
-import wfc3tools
-from wfc3tools import calwf3
-
-AUTHOR:
-Mike Dulude
-STScI
-dulude@stsci.edu
-
+#! /usr/bin/env python
 '''
-
 This code resets the TDFTRANS header keyword to zero and reprocesses with the lastest 
 version of CALWF3. 
 if not already zero, the value of sci ext header keyword TDFTRANS is reset to zero.
-If not already set to OMIT, the PHOTCORR, and DRIZCORR header values are set to OMIT.
+If not already set to OMIT, the PHOTCORR, and DRIZCORR header values are set to OMIT
+(only with -o on).
+All of the header changes to a file are made while it is open once, in update mode,
+and written with a single flush. With -d on, the changes that would be made are only
+reported, and nothing is changed or reprocessed.
+The files are reprocessed across -n processes, each writing the output of its header
+fix and calwf3 run to <log_dir>/<rootname>.log. The status of every file (pending,
+completed or failed) is appended to a journal (by default <list>.journal) as it
+changes, so that an interrupted campaign run again with the same list skips the
+files already completed. Any module.function may stand in for calwf3.calwf3 with
+--calwf3, for example a local stub for testing.
+A fingerprint of every file reprocessed, made of its size and mtime, its TDFTRANS,
+PHOTCORR, DRIZCORR and NSAMP values, and the size and mtime of its _ima and _flt
+outputs, is kept in a database (by default <log_dir>/fingerprints.db). Files whose
+fingerprint has not changed since they were last reprocessed are skipped, and files
+whose fingerprint has changed are reprocessed even if completed in the journal. The
+journal only decides for files with no stored fingerprint. -f on forces every file
+to be reprocessed.
+The wall time, CPU time (including that of calwf3's own processes) and bytes read
+and written of every stage of every file (fingerprint_check, header_read,
+header_write, calwf3 and fingerprint) are appended as JSON lines to a timing file
+(by default <log_dir>/timing.jsonl), and summarized at the end of the run with the
+totals and percentiles of each stage and the slowest files.
 INPUTS(1)
 name of ascii text file containing list of raw WFC3/IR observations to be reprocessed, one per line.
+
+AUTHOR:
+Mike Dulude
+STScI
+dulude@stsci.edu
 '''
+
+import argparse
+import contextlib
+import itertools
+import multiprocessing
+import json
+import os
+import sqlite3
+import sys
+import time
+import traceback
+import pyfits
+
+# the header keywords that go into a file's fingerprint
+PRIMARY_KEYWORDS = ["NSAMP", "PHOTCORR", "DRIZCORR"]
+SCI_KEYWORDS = ["TDFTRANS"]
+
 #---------------------------------------------------------------------------------
 
-def do_tdf_fix(imagename):
-	#summery: uses pyfits.setval to change tdftrans value to zero in all sci extensions
-	nsamp = pyfits.getval(imagename, "NSAMP", 0)
-	for samp_ctr in range(1,nsamp+1):
-		tdfval = pyfits.getval(imagename, "TDFTRANS", ('sci',samp_ctr))
-		if tdfval != 0:
-			pyfits.setval(imagename, "TDFTRANS", value=0, ext=('sci',samp_ctr))
+def do_tdf_fix(imagename, omit_switch='off', dry_run_switch='off', timings=None):
+	#summery: sets tdftrans to zero in all sci extensions, and photcorr and drizcorr to omit if omit_switch is on, in one pass with edit_headers
+	sci_edits = [("TDFTRANS", 0)]
+	primary_edits = []
+	if omit_switch == 'on':
+		primary_edits = [("PHOTCORR", 'OMIT'), ("DRIZCORR", 'OMIT')]
+	changes = edit_headers(imagename, primary_edits, sci_edits, dry_run_switch == 'on', 
+		timings)
+	for ext, keyword, old_value, new_value in changes:
+		print '{} {} {}: {} -> {}'.format(imagename, ext, keyword, old_value, new_value)
 	return imagename
 #---------------------------------------------------------------------------------
 
+def edit_headers(imagename, primary_edits, sci_edits, dry_run=False, timings=None):
+	#summery: opens imagename once and sets each (keyword, value) of primary_edits in the primary header and of sci_edits in every sci extension header, where not already set.
+	#the file is opened in update mode and flushed once on close, or opened read only for a dry run.
+	#returns the (ext, keyword, old value, new value) of each change made, or that would be made.
+	#the reading and editing, and the flush, are timed as the header_read and header_write stages.
+	changes = []
+	if dry_run:
+		mode = 'readonly'
+	else:
+		mode = 'update'
+	with timed_stage(timings, imagename, 'header_read'):
+		hdulist = pyfits.open(imagename, mode=mode)
+		try:
+			for hdu_ctr, hdu in enumerate(hdulist):
+				if hdu_ctr == 0:
+					ext, edits = 0, primary_edits
+				elif hdu.header.get('EXTNAME', '').strip().lower() == 'sci':
+					ext, edits = ('sci', hdu.header.get('EXTVER', 1)), sci_edits
+				else:
+					continue
+				for keyword, value in edits:
+					old_value = hdu.header.get(keyword)
+					if old_value != value:
+						changes.append((ext, keyword, old_value, value))
+						if not dry_run:
+							hdu.header[keyword] = value
+		except:
+			hdulist.close()
+			raise
+	with timed_stage(timings, imagename, 'header_write'):
+		hdulist.close()
+	return changes
+#---------------------------------------------------------------------------------
+
+def get_fingerprint(imagename, omit_switch='off'):
+	#summery: returns the fingerprint of imagename as a json string: its size and mtime, the fingerprint keywords of its primary and sci headers, the size and mtime (or null if missing) of its _ima and _flt outputs, and omit_switch.
+	#returns None for a missing file, which then fails when it is reprocessed.
+	if not os.path.exists(imagename):
+		return None
+	stat = os.stat(imagename)
+	keywords = {}
+	hdulist = pyfits.open(imagename)
+	try:
+		for hdu_ctr, hdu in enumerate(hdulist):
+			if hdu_ctr == 0:
+				ext, names = '0', PRIMARY_KEYWORDS
+			elif hdu.header.get('EXTNAME', '').strip().lower() == 'sci':
+				ext, names = 'sci,{}'.format(hdu.header.get('EXTVER', 1)), SCI_KEYWORDS
+			else:
+				continue
+			for keyword in names:
+				keywords['{} {}'.format(ext, keyword)] = hdu.header.get(keyword)
+	finally:
+		hdulist.close()
+	outputs = {}
+	if imagename.endswith('_raw.fits'):
+		for suffix in ['_ima.fits', '_flt.fits']:
+			output = imagename[:-len('_raw.fits')] + suffix
+			if os.path.exists(output):
+				outputs[suffix] = [os.path.getsize(output), os.path.getmtime(output)]
+			else:
+				outputs[suffix] = None
+	return json.dumps({'size' : stat.st_size, 'mtime' : stat.st_mtime, 
+		'keywords' : keywords, 'outputs' : outputs, 'omit_switch' : omit_switch}, 
+		sort_keys=True)
+#---------------------------------------------------------------------------------
+
+def load_calwf3(calwf3_name):
+	#summery: imports and returns the calwf3 function named as module.function, such as wfc3tools.calwf3.calwf3.
+	module_name, function_name = calwf3_name.rsplit('.', 1)
+	module = __import__(module_name, fromlist=[function_name])
+	return getattr(module, function_name)
+#---------------------------------------------------------------------------------
+
+def read_counters():
+	#summery: returns the current wall time, the CPU time of this process and its finished children, and the bytes it and its finished children have read and written (from /proc/self/io, or 0 where that is not available).
+	times = os.times()
+	counters = {}
+	try:
+		inf = open('/proc/self/io')
+		for line in inf:
+			name, value = line.split(':')
+			counters[name] = int(value)
+		inf.close()
+	except (IOError, ValueError):
+		pass
+	return time.time(), sum(times[:4]), counters.get('rchar', 0), counters.get('wchar', 0)
+#---------------------------------------------------------------------------------
+
+def read_fingerprints(fingerprint_file):
+	#summery: opens the fingerprint database, creating it if needed, and returns the connection and a dictionary of the fingerprint of each file.
+	connection = sqlite3.connect(fingerprint_file)
+	connection.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+		'(filename TEXT PRIMARY KEY, fingerprint TEXT, updated TEXT)')
+	fingerprints = dict(connection.execute('SELECT filename, fingerprint FROM fingerprints'))
+	return connection, fingerprints
+#---------------------------------------------------------------------------------
+
+def read_journal(journal):
+	#summery: returns a dictionary of the last status journaled for each file, empty if there is no journal yet.
+	statuses = {}
+	if os.path.exists(journal):
+		inf = open(journal)
+		for line in inf:
+			fields = line.rstrip('\n').split('\t')
+			if len(fields) == 3:
+				statuses[fields[2]] = fields[0]
+		inf.close()
+	return statuses
+#---------------------------------------------------------------------------------
+
+def report_timings(timings, slowest=10):
+	#summery: prints the count, total wall and CPU time, total bytes read and written, and 50th, 90th and 99th percentile wall time of each stage, and the slowest files by total wall time.
+	stages = []
+	for timing in timings:
+		if timing['stage'] not in stages:
+			stages.append(timing['stage'])
+	print '{:<18} {:>6} {:>10} {:>10} {:>12} {:>12} {:>8} {:>8} {:>8}'.format('stage', 'files', 
+		'wall', 'cpu', 'read', 'written', 'p50', 'p90', 'p99')
+	for stage in stages:
+		stage_timings = [timing for timing in timings if timing['stage'] == stage]
+		walls = sorted(timing['wall'] for timing in stage_timings)
+		percentiles = [walls[min(int(len(walls) * percent / 100.0), len(walls) - 1)] 
+			for percent in [50, 90, 99]]
+		print '{:<18} {:>6} {:>10.2f} {:>10.2f} {:>12} {:>12} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+			stage, len(stage_timings), sum(walls), 
+			sum(timing['cpu'] for timing in stage_timings), 
+			sum(timing['bytes_read'] for timing in stage_timings), 
+			sum(timing['bytes_written'] for timing in stage_timings), *percentiles)
+	totals = {}
+	for timing in timings:
+		totals[timing['filename']] = totals.get(timing['filename'], 0.0) + timing['wall']
+	print 'slowest files:'
+	for fits_filename in sorted(totals, key=totals.get, reverse=True)[:slowest]:
+		print '{:>10.2f} {}'.format(totals[fits_filename], fits_filename)
+#---------------------------------------------------------------------------------
+
+def reprocess_file(task):
+	#summery: fixes the headers of one raw file and runs calwf3 on it, with all output, including that of calwf3 itself, going to the file's log.
+	#returns the file name, its status ('completed' or 'failed'), the log name, the new fingerprint if completed, and the timings of its stages.
+	fits_filename, omit_switch, calwf3_name, log_dir = task
+	timings = []
+	log_name = os.path.join(log_dir, os.path.basename(fits_filename).split('.')[0] + '.log')
+	log_file = open(log_name, 'w')
+	sys.stdout.flush()
+	sys.stderr.flush()
+	saved_fds = os.dup(1), os.dup(2)
+	os.dup2(log_file.fileno(), 1)
+	os.dup2(log_file.fileno(), 2)
+	try:
+		do_tdf_fix(fits_filename, omit_switch, timings=timings)
+		calwf3 = load_calwf3(calwf3_name)
+		with timed_stage(timings, fits_filename, 'calwf3'):
+			calwf3(fits_filename)
+		with timed_stage(timings, fits_filename, 'fingerprint'):
+			fingerprint = get_fingerprint(fits_filename, omit_switch)
+		status = 'completed'
+	except Exception:
+		traceback.print_exc()
+		fingerprint = None
+		status = 'failed'
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		os.dup2(saved_fds[0], 1)
+		os.dup2(saved_fds[1], 2)
+		os.close(saved_fds[0])
+		os.close(saved_fds[1])
+		log_file.close()
+	return fits_filename, status, log_name, fingerprint, timings
+#---------------------------------------------------------------------------------
+
+def run_campaign(fitsfilelist, journal, log_dir, processes=1, omit_switch='off', 
+		calwf3_name='wfc3tools.calwf3.calwf3', fingerprint_file=None, force_switch='off', 
+		timing_file=None):
+	#summery: reprocesses every file whose fingerprint has changed since it was stored, or that has no stored fingerprint and is not completed in the journal (or every file if force_switch is on), across a pool of processes, journaling each file as pending and then as completed or failed.
+	#the timings of every stage are appended to timing_file and summarized at the end.
+	#returns the names of the files that failed.
+	if not os.path.isdir(log_dir):
+		os.makedirs(log_dir)
+	if fingerprint_file is None:
+		fingerprint_file = os.path.join(log_dir, 'fingerprints.db')
+	if timing_file is None:
+		timing_file = os.path.join(log_dir, 'timing.jsonl')
+	connection, fingerprints = read_fingerprints(fingerprint_file)
+	check_timings = []
+
+	if force_switch == 'on':
+		todo = fitsfilelist
+	else:
+		statuses = read_journal(journal)
+		todo = []
+		for fits_filename in fitsfilelist:
+			with timed_stage(check_timings, fits_filename, 'fingerprint_check'):
+				fingerprint = get_fingerprint(fits_filename, omit_switch)
+			#a stored fingerprint decides, the journal only covers files without one.
+			if fits_filename in fingerprints:
+				changed = fingerprints[fits_filename] != fingerprint
+			else:
+				changed = statuses.get(fits_filename) != 'completed'
+			if fingerprint is None or changed:
+				todo.append(fits_filename)
+	print '{} of {} files to reprocess'.format(len(todo), len(fitsfilelist))
+
+	timings = []
+	timing_output = open(timing_file, 'a')
+	def write_timings(file_timings):
+		for timing in file_timings:
+			timing_output.write(json.dumps(timing, sort_keys=True) + '\n')
+		timing_output.flush()
+		timings.extend(file_timings)
+
+	write_timings(check_timings)
+	journal_file = open(journal, 'a')
+	def write_journal(status, fits_filename):
+		journal_file.write('{}\t{}\t{}\n'.format(status, time.strftime('%Y-%m-%dT%H:%M:%S'), 
+			fits_filename))
+		journal_file.flush()
+		os.fsync(journal_file.fileno())
+
+	for fits_filename in todo:
+		write_journal('pending', fits_filename)
+
+	tasks = [(fits_filename, omit_switch, calwf3_name, log_dir) for fits_filename in todo]
+	pool = None
+	if processes > 1:
+		# a fresh worker for every file, so that nothing leaks from one calwf3 run to the next
+		pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+		results = pool.imap_unordered(reprocess_file, tasks)
+	else:
+		results = itertools.imap(reprocess_file, tasks)
+
+	failed = []
+	try:
+		for fits_filename, status, log_name, fingerprint, file_timings in results:
+			write_timings(file_timings)
+			write_fingerprint(connection, fits_filename, fingerprint)
+			write_journal(status, fits_filename)
+			print '{} {} (log: {})'.format(fits_filename, status, log_name)
+			if status == 'failed':
+				failed.append(fits_filename)
+		if pool is not None:
+			pool.close()
+	except:
+		if pool is not None:
+			pool.terminate()
+		raise
+	finally:
+		if pool is not None:
+			pool.join()
+		journal_file.close()
+		timing_output.close()
+		connection.close()
+
+	print '{} completed, {} failed'.format(len(todo) - len(failed), len(failed))
+	report_timings(timings)
+	return failed
+#---------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def timed_stage(timings, fits_filename, stage):
+	#summery: times the enclosed block and appends its file, stage, start time, wall and CPU time and bytes read and written to timings, unless timings is None.
+	start = read_counters()
+	try:
+		yield
+	finally:
+		if timings is not None:
+			end = read_counters()
+			timings.append({'filename' : fits_filename, 'stage' : stage, 
+				'start' : time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start[0])), 
+				'wall' : end[0] - start[0], 'cpu' : end[1] - start[1], 
+				'bytes_read' : end[2] - start[2], 'bytes_written' : end[3] - start[3]})
+#---------------------------------------------------------------------------------
+
+def write_fingerprint(connection, fits_filename, fingerprint):
+	#summery: stores the fingerprint of a reprocessed file, or forgets the file's fingerprint if fingerprint is None, so that it is reprocessed next time.
+	if fingerprint is None:
+		connection.execute('DELETE FROM fingerprints WHERE filename = ?', (fits_filename,))
+	else:
+		connection.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)', 
+			(fits_filename, fingerprint, time.strftime('%Y-%m-%dT%H:%M:%S')))
+	connection.commit()
+#---------------------------------------------------------------------------------
+
+def parse_args():
+	#summery: parse command line arguments, returns args object.
+	filename_help = 'Name of ascii text file containing list of raw WFC3/IR ' + \
+		'observations to be reprocessed, one per line.'
+	omit_switch_help = 'If "on", PHOTCORR and DRIZCORR are also set to OMIT.'
+	dry_run_switch_help = 'If "on", only report the header changes that would ' + \
+		'be made, without changing or reprocessing anything.'
+	processes_help = 'The number of files to reprocess at once.'
+	journal_help = 'Path to the checkpoint journal. Defaults to <list>.journal.'
+	log_dir_help = 'Directory for the per-file logs. Defaults to the current ' + \
+		'directory.'
+	calwf3_help = 'The module.function to run in place of wfc3tools.calwf3.calwf3.'
+	fingerprint_file_help = 'Path to the fingerprint database. Defaults to ' + \
+		'<log_dir>/fingerprints.db.'
+	timing_file_help = 'Path to the JSON lines file of stage timings. ' + \
+		'Defaults to <log_dir>/timing.jsonl.'
+	force_switch_help = 'If "on", every file is reprocessed, even if its ' + \
+		'fingerprint is unchanged or it is completed in the journal.'
+	parser = argparse.ArgumentParser()
+	parser.add_argument('filename', type=str, help=filename_help)
+	parser.add_argument('-o', '--omit_switch', type=str, help=omit_switch_help, 
+		action='store', required=False, default='off')
+	parser.add_argument('-d', '--dry_run_switch', type=str, 
+		help=dry_run_switch_help, action='store', required=False, default='off')
+	parser.add_argument('-n', '--processes', type=int, help=processes_help, 
+		action='store', required=False, default=1)
+	parser.add_argument('-j', '--journal', type=str, help=journal_help, 
+		action='store', required=False, default=None)
+	parser.add_argument('-l', '--log_dir', type=str, help=log_dir_help, 
+		action='store', required=False, default='.')
+	parser.add_argument('--calwf3', type=str, help=calwf3_help, 
+		action='store', required=False, default='wfc3tools.calwf3.calwf3')
+	parser.add_argument('--fingerprint_file', type=str, help=fingerprint_file_help, 
+		action='store', required=False, default=None)
+	parser.add_argument('--timing_file', type=str, help=timing_file_help, 
+		action='store', required=False, default=None)
+	parser.add_argument('-f', '--force_switch', type=str, help=force_switch_help, 
+		action='store', required=False, default='off')
+	args = parser.parse_args()
+	return args
+#---------------------------------------------------------------------------------
+
+def test_args(args):
+	#summery: ensure valid command line arguments.
+	assert os.path.exists(args.filename) == True, \
+		'File {} does not exist'.format(args.filename)
+	assert args.omit_switch in ['on', 'off'], \
+		'omit_switch can be "on" or "off".'
+	assert args.dry_run_switch in ['on', 'off'], \
+		'dry_run_switch can be "on" or "off".'
+	assert args.force_switch in ['on', 'off'], \
+		'force_switch can be "on" or "off".'
+	assert args.processes > 0, 'processes must be greater than 0.'
+	assert '.' in args.calwf3, 'calwf3 must be given as module.function.'
+#---------------------------------------------------------------------------------
+
+
+
+if __name__ == '__main__':
 
+	args = parse_args()
+	test_args(args)
 
-filename=sys.argv[1]
+	inf = open(args.filename)
+	fitsfilelist = inf.readlines()
+	inf.close()
 
-inf = open(filename)
-fitsfilelist = inf.readlines()
-inf.close()
+	fitsfilelist = [fits_filename.strip() for fits_filename in fitsfilelist 
+		if fits_filename.strip()]
 
-for fits_filename in fitsfilelist:
-	fits_filename = fits_filename.strip()
-	blarg = do_tdf_fix(fits_filename)
-	#pyfits.setval(fits_filename, "PHOTCORR", value='OMIT', ext=0)
-	#pyfits.setval(fits_filename, "DRIZCORR", value='OMIT', ext=0)
-	calwf3.calwf3(fits_filename)
+	if args.dry_run_switch == 'on':
+		for fits_filename in fitsfilelist:
+			blarg = do_tdf_fix(fits_filename, args.omit_switch, args.dry_run_switch)
+	else:
+		journal = args.journal
+		if journal is None:
+			journal = os.path.splitext(args.filename)[0] + '.journal'
+		failed = run_campaign(fitsfilelist, journal, args.log_dir, args.processes, 
+			args.omit_switch, args.calwf3, args.fingerprint_file, args.force_switch, 
+			args.timing_file)
+		sys.exit(1 if failed else 0)